@@ -1,64 +1,202 @@
-import grequests
-import requests
+import gzip
 import json
+import requests
 import pathlib
 from tqdm import tqdm
 
+import fetch
 import utils
 
 DATA_PATH = pathlib.Path('Data')
-BATCH_SIZE = 100
 
 
-def scraper(overwrite=False):
+def scraper(overwrite=False, workers=16, rate=20):
+    """
+    Crawl the deck tables of every commander and merge the deck hashes into deckhash.txt.
+    The ETag and Last-Modified headers of every commander page are cached in Data/commander_cache.json
+    and sent as conditional requests, so a refresh only downloads the tables that changed.
+    With <overwrite>, or without deckhash.txt, every table is downloaded and deckhash.txt is rewritten.
+    """
     deckhashes = DATA_PATH / 'deckhash.txt'
-    if deckhashes.exists() and not overwrite:
-        return
+    cache_file = DATA_PATH / 'commander_cache.json'
+    overwrite = overwrite or not deckhashes.exists()
+
+    cache = dict()
+    if cache_file.exists() and not overwrite:
+        with open(cache_file, 'r') as file:
+            cache = json.load(file)
+
+    known = list()
+    if not overwrite:
+        with open(deckhashes, 'r') as file:
+            known = file.read().splitlines()
+    seen = set(known)
+
+    session = fetch.make_session(workers)
+    bucket = fetch.TokenBucket(rate) if rate else None
+
+    r = fetch.get(session, 'https://json.edhrec.com/static/typeahead/commanders', bucket)
+    commanders = {utils.sanitize(commander): commander for commander in json.loads(r.content)}
 
-    r = requests.get('https://json.edhrec.com/static/typeahead/commanders')
-    commanders = json.loads(r.content)
-
-    file = open(deckhashes, 'w')
-    for commander in tqdm(commanders):
-        r = requests.get(f'https://json.edhrec.com/pages/decks/{utils.sanitize(commander)}.json')
-        if r.status_code == 200:
-            decks = json.loads(r.content)['table']
-            for deck in decks:
-                file.write(deck['urlhash'] + '\n')
-        else:
-            print(f'Error: {commander} - {utils.sanitize(commander)}')
+    def crawl(name):
+        headers = dict()
+        entry = cache.get(name, dict())
+        if 'etag' in entry:
+            headers['If-None-Match'] = entry['etag']
+        if 'last_modified' in entry:
+            headers['If-Modified-Since'] = entry['last_modified']
+        try:
+            return fetch.get(session, f'https://json.edhrec.com/pages/decks/{name}.json', bucket, headers=headers)
+        except requests.RequestException as e:
+            return e
+
+    new = list()
+    changed = 0
+    for name, r in tqdm(fetch.window(crawl, commanders, workers), total=len(commanders)):
+        if isinstance(r, Exception):
+            print(f'Error: {commanders[name]} - {name}')
+            print(f'Error: {r}')
+            continue
+        if r.status_code == 304:
+            continue
+        if r.status_code != 200:
+            print(f'Error: {commanders[name]} - {name}')
             print(f'Error: {r.status_code}')
             print(r.content)
-    file.close()
+            continue
+
+        changed += 1
+        for deck in json.loads(r.content)['table']:
+            if deck['urlhash'] not in seen:
+                seen.add(deck['urlhash'])
+                new.append(deck['urlhash'])
+        cache[name] = dict()
+        if 'ETag' in r.headers:
+            cache[name]['etag'] = r.headers['ETag']
+        if 'Last-Modified' in r.headers:
+            cache[name]['last_modified'] = r.headers['Last-Modified']
+
+    # append only, the downloader works through the hashes in file order
+    with open(deckhashes, 'w' if overwrite else 'a') as file:
+        for deckhash in new:
+            file.write(deckhash + '\n')
+    with open(cache_file, 'w') as file:
+        json.dump(cache, file)
+    print(f'{changed} of {len(commanders)} commanders changed, {len(new)} new decks')
+
+
+def downloaded_hashes(deck_dir):
+    """
+    Hashes of the decks already in <deck_dir>, as <hash>.json files or in compressed shards.
+    """
+    hashes = {file.stem for file in deck_dir.glob('*.json')}
+    for shard in deck_dir.glob('*.jsonl.gz'):
+        with gzip.open(shard, 'rt') as f:
+            hashes.update(json.loads(line)['urlhash'] for line in f if line.strip())
+    return hashes
+
 
+class GzipShardWriter:
+    """
+    Writes raw decks as gzip compressed json lines shards of <shard_size> decks.
+    A shard only gets its final name when it is complete, so an interrupted run never leaves a partial shard.
+    """
+    def __init__(self, directory, shard_size):
+        self.directory = directory
+        self.shard_size = shard_size
+        self.shard = len(list(directory.glob('shard-*.jsonl.gz')))
+        self.count = 0
+        self.file = None
 
-def downloader():
+    def _path(self):
+        return self.directory / f'shard-{self.shard:05d}.jsonl.gz'
+
+    def write(self, data):
+        if self.file is None:
+            self.file = gzip.open(self._path().with_suffix('.gz.tmp'), 'wt')
+        self.file.write(json.dumps(data) + '\n')
+        self.count += 1
+        if self.count == self.shard_size:
+            self.close()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self._path().with_suffix('.gz.tmp').replace(self._path())
+            self.file = None
+            self.shard += 1
+            self.count = 0
+
+
+def _save_failures(failures_file, failures):
+    tmp = failures_file.with_name(failures_file.name + '.tmp')
+    with open(tmp, 'w') as file:
+        json.dump(failures, file)
+    tmp.replace(failures_file)
+
+
+def downloader(workers=16, rate=20, shard_size=None, retry_failed=False):
+    """
+    Download the decks in deckhash.txt with at most <workers> requests in flight and <rate> requests per second.
+    Decks already in Data/decks are skipped, so an interrupted crawl can be restarted.
+    Failed downloads are kept in Data/download_failures.json and only retried with <retry_failed>.
+    With <shard_size>, decks are written to gzip json lines shards of <shard_size> decks instead of one file per deck.
+    """
     deck_dir = DATA_PATH / 'decks'
     deckhashes = DATA_PATH / 'deckhash.txt'
+    failures_file = DATA_PATH / 'download_failures.json'
 
     if not deck_dir.exists() or not deckhashes.exists():
         print(f'Error: Missing {deckhashes} or {deck_dir} directory')
         return
 
     with open(deckhashes, 'r') as file:
-        deckhashes = file.read().splitlines()
-    amount_of_decks = len(deckhashes)
-    for index in tqdm(range(0, amount_of_decks, BATCH_SIZE)):
-        batch = set()
-        for offset in range(0, BATCH_SIZE):
-            if index + offset >= amount_of_decks:
-                continue
-            batch.add(grequests.get(f'https://json.edhrec.com/pages/deckpreview-temp/{deckhashes[index + offset]}.json'))
-
-        for resp in grequests.imap(batch):
-            filename = resp.url.split('/')[-1]
-            if resp.status_code == 200:
-                with open(deck_dir / filename, 'wb') as file:
-                    file.write(resp.content)
+        deckhashes = list(dict.fromkeys(file.read().splitlines()))
+    failures = dict()
+    if failures_file.exists():
+        with open(failures_file, 'r') as file:
+            failures = json.load(file)
+
+    downloaded = downloaded_hashes(deck_dir)
+    todo = [h for h in deckhashes if h not in downloaded and (retry_failed or h not in failures)]
+    print(f'{len(deckhashes) - len(todo)} of {len(deckhashes)} decks downloaded or failed before')
+
+    session = fetch.make_session(workers)
+    bucket = fetch.TokenBucket(rate) if rate else None
+    writer = GzipShardWriter(deck_dir, shard_size) if shard_size else None
+
+    def download(deckhash):
+        try:
+            return fetch.get(session, f'https://json.edhrec.com/pages/deckpreview-temp/{deckhash}.json', bucket)
+        except requests.RequestException as e:
+            return e
+
+    try:
+        for count, (deckhash, r) in enumerate(tqdm(fetch.window(download, todo, workers), total=len(todo))):
+            if isinstance(r, Exception):
+                failures[deckhash] = str(r)
+            elif r.status_code != 200:
+                failures[deckhash] = r.status_code
+            elif writer is not None:
+                writer.write(json.loads(r.content))
+                failures.pop(deckhash, None)
             else:
-                print(f'File: {filename}')
-                print(f'Error: {resp.status_code}')
-                print(resp.content)
+                # renamed when complete, a truncated file would count as downloaded (see downloaded_hashes)
+                tmp = deck_dir / f'{deckhash}.json.tmp'
+                with open(tmp, 'wb') as file:
+                    file.write(r.content)
+                tmp.replace(deck_dir / f'{deckhash}.json')
+                failures.pop(deckhash, None)
+
+            if count % 1000 == 999:
+                _save_failures(failures_file, failures)
+    finally:
+        if writer is not None:
+            writer.close()
+        _save_failures(failures_file, failures)
+
+    if failures:
+        print(f'{len(failures)} decks failed, see {failures_file}')
 
 
 if __name__ == '__main__':
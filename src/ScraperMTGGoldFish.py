@@ -1,67 +1,189 @@
+import json
 import pathlib
 import time
+from concurrent.futures import ProcessPoolExecutor
 
 import requests
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 
 from tqdm import tqdm
 
+import fetch
 
-def scraper():
-    r = requests.get('https://www.mtggoldfish.com/deck/custom/standard#paper')
-    soup = BeautifulSoup(r.content, 'html.parser')
+try:
+    import lxml # noqa: F401
+    PARSER = 'lxml'
+except ImportError:
+    PARSER = 'html.parser'
 
-    pagination = soup.find('ul', class_='pagination')
-    paginationItems = pagination.findChildren('li')
+CHECKPOINT = pathlib.Path('Data/mtggoldfish_checkpoint.json')
+PAGES_PER_FILE = 10
+
+
+def deckids_file(page):
+    return pathlib.Path(f'Data/deckids/deckids-{page}-{page+PAGES_PER_FILE-1}.txt')
+
+
+def load_checkpoint():
+    """
+    Progress of the crawl: the last listing page scraped, the first page of the deck id file the downloader is at,
+    the deck ids of that file that were already downloaded and the deck ids that failed, to retry.
+    """
+    if not CHECKPOINT.exists():
+        return {'scraped_page': 0, 'last_page': 1, 'downloaded': list(), 'failed': list()}
+    with open(CHECKPOINT, 'r') as file:
+        return json.load(file)
+
+
+def save_checkpoint(checkpoint):
+    tmp = CHECKPOINT.with_name(CHECKPOINT.name + '.tmp')
+    with open(tmp, 'w') as file:
+        json.dump(checkpoint, file)
+    tmp.replace(CHECKPOINT)
+
+
+def parse_pages(content):
+    # only parse the pagination
+    soup = BeautifulSoup(content, PARSER, parse_only=SoupStrainer('ul', class_='pagination'))
+    paginationItems = soup.find('ul', class_='pagination').findChildren('li')
     # The second last item is the last page
-    pages = int(paginationItems[-2].text)
-
-    for i in tqdm(range(1, pages + 1, 10), desc="Pages"):
-        deckids = list()
-        for j in range(10):
-            if i + j > pages:
-                break
-            r = requests.get('https://www.mtggoldfish.com/deck/custom/standard?page=' + str(i + j) + "#paper")
-            soup = BeautifulSoup(r.content, 'html.parser')
-            s = soup.find('div', class_='deck-display')
-            decks = s.find_all('span', class_='deck-price-paper')
-
-            for deck in decks:
-                for child in deck.findChildren():
-                    deckid = child.get('href')
-                    if deckid is not None:
-                        deckid = deckid.split('/')[-1]
-                        deckid = deckid.split('#')[0]
-                        deckids.append(deckid)
-
-        file = open(f'Data/deckids/deckids-{i}-{i+9}.txt', 'w')
-        for deckid in deckids:
-            file.write(deckid + '\n')
-        file.close()
+    return int(paginationItems[-2].text)
+
+
+def parse_page(content):
+    """
+    Deck ids on a listing page, only the deck-display region of the page is parsed.
+    """
+    soup = BeautifulSoup(content, PARSER, parse_only=SoupStrainer('div', class_='deck-display'))
+    deckids = list()
+    for deck in soup.find_all('span', class_='deck-price-paper'):
+        for child in deck.findChildren():
+            deckid = child.get('href')
+            if deckid is not None:
+                deckid = deckid.split('/')[-1]
+                deckid = deckid.split('#')[0]
+                deckids.append(deckid)
+    return deckids
+
 
+def scraper(workers=8, rate=5, parse_workers=None):
+    """
+    Write the deck ids of every listing page to Data/deckids, one file per 10 pages.
+    Pages are downloaded by <workers> threads while a pool of <parse_workers> processes parses the previous pages,
+    the crawl continues after the last page in the checkpoint.
+    A group of pages with a page that failed (after the retries of fetch.get) is not written and the crawl goes on,
+    but the checkpoint stays before it, so the next run scrapes it again.
+    """
+    session = fetch.make_session(workers)
+    bucket = fetch.TokenBucket(rate) if rate else None
+    checkpoint = load_checkpoint()
 
-def downloader():
-    last_page = 1
+    r = fetch.get(session, 'https://www.mtggoldfish.com/deck/custom/standard#paper', bucket)
+    r.raise_for_status()
+    pages = parse_pages(r.content)
+
+    def download(page):
+        try:
+            r = fetch.get(session, 'https://www.mtggoldfish.com/deck/custom/standard?page=' + str(page) + "#paper", bucket)
+        except requests.RequestException as e:
+            return e
+        # an error page has no deck ids, it must not be taken for an empty listing page
+        if r.status_code != 200:
+            return requests.HTTPError(f'{r.status_code} for page {page}', response=r)
+        return r.content
+
+    failed = list() # first pages of the groups that failed in this run
+
+    def write(i, futures):
+        with open(deckids_file(i), 'w') as file:
+            for future in futures:
+                for deckid in future.result():
+                    file.write(deckid + '\n')
+        if not failed:
+            checkpoint['scraped_page'] = i + PAGES_PER_FILE - 1
+            save_checkpoint(checkpoint)
+
+    with ProcessPoolExecutor(parse_workers) as pool:
+        pending = None
+        for i in tqdm(range(checkpoint['scraped_page'] + 1, pages + 1, PAGES_PER_FILE), desc="Pages"):
+            group = range(i, min(i + PAGES_PER_FILE, pages + 1))
+            contents = dict(fetch.window(download, group, workers))
+            errors = [contents[page] for page in group if isinstance(contents[page], Exception)]
+            futures = [pool.submit(parse_page, contents[page]) for page in group] if not errors else None
+            # the previous pages were parsed while this group was downloading
+            if pending is not None:
+                write(*pending)
+            pending = (i, futures) if futures is not None else None
+            if errors:
+                print(f'Pages {i}-{group[-1]} failed, they are scraped again on the next run: {errors[0]}')
+                failed.append(i)
+        if pending is not None:
+            write(*pending)
+    return failed
+
+
+def downloader(workers=8, rate=5):
+    """
+    Download the decks of every deck id file, continuing where the checkpoint stopped.
+    Decks that fail are kept in the checkpoint and retried at the start of the next run.
+    """
+    session = fetch.make_session(workers)
+    bucket = fetch.TokenBucket(rate) if rate else None
+    checkpoint = load_checkpoint()
+    checkpoint.setdefault('failed', list())
+
+    def download(deckid):
+        try:
+            return fetch.get(session, 'https://www.mtggoldfish.com/deck/download/' + str(deckid), bucket)
+        except requests.RequestException as e:
+            return e
+
+    def download_all(deckids):
+        # return the deck ids that failed
+        failed = list()
+        try:
+            for count, (deckid, r) in enumerate(fetch.window(download, deckids, workers)):
+                if isinstance(r, Exception):
+                    print(r)
+                    failed.append(deckid)
+                elif r.status_code == 200:
+                    file = open(f'Data/decks/{deckid}.txt', 'wb')
+                    file.write(r.content)
+                    file.close()
+                    checkpoint['downloaded'].append(deckid)
+                else:
+                    print(r.status_code)
+                    failed.append(deckid)
+                if count % 50 == 49:
+                    save_checkpoint(checkpoint)
+        finally:
+            save_checkpoint(checkpoint)
+        return failed
+
+    if checkpoint['failed']:
+        checkpoint['failed'] = download_all(checkpoint['failed'])
+        save_checkpoint(checkpoint)
+        print(f'Retried failed decks, {len(checkpoint["failed"])} still failing')
 
     while True:
         startTime = time.time()
-        if not pathlib.Path(f'Data/deckids/deckids-{last_page}-{last_page+9}.txt').exists():
+        last_page = checkpoint['last_page']
+        if not deckids_file(last_page).exists():
             break
-        file = open(f'Data/deckids/deckids-{last_page}-{last_page+9}.txt', 'r')
+        file = open(deckids_file(last_page), 'r')
         deckids = file.read().splitlines()
         file.close()
-        for deckid in deckids:
-            r = requests.get('https://www.mtggoldfish.com/deck/download/' + str(deckid))
-
-            if r.status_code == 200:
-                file = open(f'Data/decks/{deckid}.txt', 'wb')
-                file.write(r.content)
-                file.close()
-            else:
-                print(r.status_code)
-
-        last_page += 10
-        print(f'Time for page {last_page}-{last_page+9}: {time.time() - startTime}')
+
+        downloaded = set(checkpoint['downloaded'])
+        todo = [deckid for deckid in dict.fromkeys(deckids) if deckid not in downloaded]
+        failed = download_all(todo)
+
+        # the file is done, its failed decks move to the checkpoint's retry list
+        checkpoint['failed'].extend(deckid for deckid in failed if deckid not in checkpoint['failed'])
+        checkpoint['last_page'] = last_page + PAGES_PER_FILE
+        checkpoint['downloaded'] = list()
+        save_checkpoint(checkpoint)
+        print(f'Time for page {last_page}-{last_page+PAGES_PER_FILE-1}: {time.time() - startTime}')
 
 
 if __name__ == '__main__':
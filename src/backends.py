@@ -0,0 +1,675 @@
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import requests
+
+import constants
+import corpus
+import instrumentation
+import lsh
+import shards
+import snapshots
+from vocabulary import Vocabulary
+
+
+# Lucene stores field lengths in a single byte, see SmallFloat.intToByte4 / byte4ToInt
+def _long_to_int4(i):
+    num_bits = i.bit_length()
+    if num_bits < 4:
+        return i
+    shift = num_bits - 4
+    encoded = (i >> shift) & 0x07
+    return encoded | ((shift + 1) << 3)
+
+
+def _int4_to_long(i):
+    bits = i & 0x07
+    shift = (i >> 3) - 1
+    if shift == -1:
+        return bits
+    return (bits | 0x08) << shift
+
+
+_NUM_FREE_VALUES = 255 - _long_to_int4(2**31 - 1)
+
+
+def quantize_length(length):
+    """
+    Round a field length the same way Lucene does when it stores the length norm.
+    """
+    if length < _NUM_FREE_VALUES:
+        return length
+    return _NUM_FREE_VALUES + _int4_to_long(_long_to_int4(length - _NUM_FREE_VALUES))
+
+
+# Class to fetch term document frequency
+# Statistics are snapshotted to constants.CACHE keyed by the Solr index version and memory-mapped by later processes.
+class Terms:
+    terms = None
+    size = None
+    version = None
+    @staticmethod
+    def get_index_version():
+        if Terms.version is None:
+            r = requests.get(f'{constants.SOLR_URL}/admin/luke', params={
+                'numTerms': 0,
+                'show': 'index',
+            })
+            Terms.version = r.json()['index']['version']
+        return Terms.version
+
+    @staticmethod
+    def _load():
+        with instrumentation.timer('terms.load'):
+            Terms._load_snapshot()
+
+    @staticmethod
+    def _load_snapshot():
+        version = Terms.get_index_version()
+        if not snapshots.exists('terms', version):
+            terms = requests.get(f'{constants.SOLR_URL}/terms', params={
+                'terms.fl': 'cards',
+                'terms.limit': -1,
+            }).json()['terms']['cards']
+            r = requests.get(f'{constants.SOLR_URL}/select', params={
+                'q': '*:*',
+                'rows': 0
+            })
+            snapshots.save('terms', version, {
+                'cards': snapshots.encode_strings(terms[0::2]),
+                'df': np.array(terms[1::2], dtype=np.int64),
+            }, {'size': r.json()['response']['numFound']})
+
+        arrays, meta = snapshots.load('terms', version)
+        Terms.terms = dict(zip(snapshots.decode_strings(arrays['cards']), arrays['df'].tolist()))
+        Terms.size = meta['size']
+
+    @staticmethod
+    def get_terms():
+        if Terms.terms is None:
+            Terms._load()
+        return Terms.terms
+
+    @staticmethod
+    def get_collection_size():
+        if Terms.size is None:
+            Terms._load()
+        return Terms.size
+
+    @staticmethod
+    def refresh():
+        """
+        Forget the statistics of this process, they are reloaded (and re-downloaded if the index changed) on next use.
+        """
+        Terms.terms = None
+        Terms.size = None
+        Terms.version = None
+
+
+def csr_positions(indptr, rows):
+    """
+    Positions of the entries of <rows> in a CSR matrix with row pointers <indptr>, and the length of every row.
+    """
+    starts = indptr[rows]
+    lengths = indptr[rows + 1] - starts
+    return np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum()), lengths
+
+
+# similar decks of one query: deck ids, scores and the decks' card ids in CSR layout (indptr, indices)
+Neighbours = namedtuple('Neighbours', ['ids', 'scores', 'indptr', 'indices'])
+
+
+class SolrBackend:
+    """
+    Reference backend: Solr's /mlt handler on the 'decks' core.
+    """
+    def __init__(self, url=None, workers=8, timeout=60):
+        self.url = url
+        self.workers = workers
+        self.timeout = timeout
+        self.reconnect()
+        self._vocabulary = None
+
+    def reconnect(self):
+        """
+        Start a new connection pool, e.g. in a forked process: the keep-alive connections of the parent can't be shared.
+        """
+        self.session = requests.Session()
+        self.session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=self.workers))
+
+    def _url(self):
+        return self.url if self.url is not None else constants.SOLR_URL
+
+    def similar_decks(self, deck_string, rows):
+        """
+        Return the <rows> most similar decks as (deck id, score, cards) tuples.
+        """
+        with instrumentation.timer('solr.mlt'):
+            r = self.session.get(f'{self._url()}/mlt', params={
+                'stream.body': deck_string,
+                'mlt.interestingTerms': 'details',
+                'mlt.mindf': 0,
+                'mlt.mintf': 0,
+                'mlt.boost': 'true',
+                'fl': 'id, cards, score',
+                'rows': rows
+            }, timeout=self.timeout)
+        with instrumentation.timer('solr.json'):
+            docs = r.json()['response']['docs']
+        instrumentation.observe('solr.similar_decks', len(docs))
+
+        return [(deck['id'], deck['score'], deck['cards'].split(' ')) for deck in docs]
+
+    def similar_decks_batch(self, deck_strings, rows):
+        """
+        Return Neighbours for every query deck, the /mlt requests are sent concurrently.
+        """
+        vocabulary = self.vocabulary()
+        with ThreadPoolExecutor(self.workers) as executor:
+            results = list(executor.map(lambda deck_string: self.similar_decks(deck_string, rows), deck_strings))
+
+        neighbours = list()
+        with instrumentation.timer('solr.encode'):
+            for decks in results:
+                cards = [vocabulary.encode(deck_cards) for _, _, deck_cards in decks]
+                indptr = np.concatenate(([0], np.cumsum([len(c) for c in cards]))).astype(np.int64)
+                indices = np.concatenate(cards).astype(np.int64) if cards else np.zeros(0, dtype=np.int64)
+                neighbours.append(Neighbours([d[0] for d in decks], np.array([d[1] for d in decks], dtype=np.float64), indptr, indices))
+        return neighbours
+
+    def vocabulary(self):
+        """
+        Vocabulary of all cards, in the order of the Solr terms.
+        """
+        if self._vocabulary is None:
+            self._vocabulary = Vocabulary(Terms.get_terms())
+            self._df = np.array(list(Terms.get_terms().values()), dtype=np.int64)
+        return self._vocabulary
+
+    def document_frequencies(self):
+        self.vocabulary()
+        return self._df
+
+    def version(self):
+        return Terms.get_index_version()
+
+    def cache_key(self):
+        return f'solr:{self._url()}:{self.version()}'
+
+    def terms(self):
+        return Terms.get_terms()
+
+    def collection_size(self):
+        return Terms.get_collection_size()
+
+
+class MatrixBackend:
+    """
+    In-process backend holding the stored decks as a deck x card sparse matrix (CSR).
+    Similarity mimics the Solr /mlt handler with mlt.boost=true:
+        + the <max_query_terms> query cards with the highest tf * idf become the query
+        + every query card is boosted by its tf * idf relative to the best query card
+        + decks are scored with BM25 (Lucene's default similarity)
+    """
+    def __init__(self, directory=None, max_query_terms=25, k1=1.2, b=0.75):
+        self.directory = directory if directory is not None else constants.STORED_DECKS
+        self.max_query_terms = max_query_terms
+        self.k1 = k1
+        self.b = b
+
+        self._load()
+
+    def _load(self):
+        # use the packed corpus of the directory if there is one, otherwise parsing every deck file is slow,
+        # so the matrix is snapshotted and reused until the directory changes
+        packed = corpus.open_corpus(self.directory)
+        if packed is not None:
+            self._version = packed.meta['version']
+            arrays = packed.arrays
+        else:
+            self._version = snapshots.directory_version(self.directory)
+            if not snapshots.exists('matrix', self._version):
+                snapshots.save('matrix', self._version, corpus.read_decks(corpus.iter_decks(self.directory)))
+            arrays, _ = snapshots.load('matrix', self._version)
+
+        self.ids = snapshots.decode_strings(arrays['ids'])
+        self._vocabulary = Vocabulary.from_array(arrays['cards'])
+        self.cards = self._vocabulary.cards
+        self.card_index = self._vocabulary.card_index
+        self.indptr = arrays['indptr']
+        self.indices = arrays['indices']
+        self.counts = arrays['counts']
+        self.sequence_ptr = arrays['sequence_ptr']
+        self.sequence = arrays['sequence']
+        self._prepare()
+
+    def _prepare(self):
+        n_decks = len(self.indptr) - 1
+        n_cards = len(self.cards)
+
+        deck_of_posting = np.repeat(np.arange(n_decks), np.diff(self.indptr))
+        self.df = np.bincount(self.indices, minlength=n_cards)
+        counts = self.counts.astype(np.float64)
+        lengths = np.bincount(deck_of_posting, weights=counts, minlength=n_decks)
+        avgdl = lengths.sum() / n_decks
+
+        # idf used by MoreLikeThis to pick query terms (ClassicSimilarity) and by BM25 to score decks
+        self.classic_idf = np.log((n_decks + 1) / (self.df + 1)) + 1.0
+        self.bm25_idf = np.log(1 + (n_decks - self.df + 0.5) / (self.df + 0.5))
+
+        # per posting BM25 term frequency part, in deck order
+        table = np.array([quantize_length(l) for l in range(int(lengths.max(initial=0)) + 1)], dtype=np.float64)
+        quantized = table[lengths.astype(np.int64)]
+        norms = self.k1 * ((1 - self.b) + self.b * quantized / avgdl)
+        tf_norm = counts / (counts + norms[deck_of_posting])
+        self.tf_norm = tf_norm
+
+        # card -> decks postings (CSC)
+        order = np.argsort(self.indices, kind='stable')
+        self.postings_ptr = np.concatenate(([0], np.cumsum(self.df)))
+        self.postings = deck_of_posting[order]
+        self.postings_tf_norm = tf_norm[order]
+
+        self._terms = dict(zip(self.cards, self.df.tolist()))
+
+    def query_terms(self, deck_string):
+        """
+        Return the card ids and boosts MoreLikeThis would use for this query deck.
+        """
+        tf = Counter(card for card in deck_string.split() if card in self.card_index)
+        if not tf:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+
+        # ties are broken alphabetically, like Lucene's priority queue does
+        terms = sorted(tf, key=lambda card: (-tf[card] * self.classic_idf[self.card_index[card]], card))
+        terms = terms[:self.max_query_terms]
+        card_ids = np.array([self.card_index[card] for card in terms], dtype=np.int64)
+        scores = np.array([tf[card] for card in terms]) * self.classic_idf[card_ids]
+
+        return card_ids, scores / scores[0]
+
+    def score(self, card_ids, boosts):
+        """
+        Score every stored deck against the weighted query cards.
+        """
+        return self.score_batch([(card_ids, boosts)])[0]
+
+    def score_batch(self, queries):
+        """
+        Score every stored deck against every query, <queries> is a list of (card ids, boosts).
+        Return a queries x decks matrix.
+        """
+        n_decks = len(self.ids)
+        keys = list()
+        weights = list()
+        for q, (card_ids, boosts) in enumerate(queries):
+            positions, lengths = csr_positions(self.postings_ptr, card_ids)
+            keys.append(self.postings[positions] + q * n_decks)
+            weights.append(np.repeat(boosts * self.bm25_idf[card_ids], lengths) * self.postings_tf_norm[positions])
+
+        scores = np.bincount(np.concatenate(keys), weights=np.concatenate(weights), minlength=len(queries) * n_decks)
+        return scores.reshape(len(queries), n_decks)
+
+    def top_decks(self, scores, rows):
+        """
+        Indices of the <rows> highest scoring decks that match at least one query card.
+        """
+        candidates = np.flatnonzero(scores > 0)
+        if rows < len(candidates):
+            # keep every deck tied with the last one, argpartition picks an arbitrary subset of them
+            cutoff = -np.partition(-scores[candidates], rows - 1)[rows - 1]
+            candidates = candidates[scores[candidates] >= cutoff]
+        # stable sort on deck order to break ties like Solr does on internal document id
+        return candidates[np.lexsort((candidates, -scores[candidates]))][:rows]
+
+    def neighbours(self, scores, rows):
+        """
+        Neighbours for one row of deck scores.
+        """
+        top = self.top_decks(scores, rows)
+        positions, lengths = csr_positions(self.indptr, top)
+        indptr = np.concatenate(([0], np.cumsum(lengths)))
+
+        return Neighbours([self.ids[i] for i in top], scores[top], indptr, self.indices[positions].astype(np.int64))
+
+    def deck_cards(self, index):
+        return [self.cards[i] for i in self.indices[self.indptr[index]:self.indptr[index + 1]]]
+
+    def similar_decks(self, deck_string, rows):
+        """
+        Return the <rows> most similar decks as (deck id, score, cards) tuples.
+        """
+        scores = self.score(*self.query_terms(deck_string))
+        return [(self.ids[i], float(scores[i]), self.deck_cards(i)) for i in self.top_decks(scores, rows)]
+
+    def similar_decks_batch(self, deck_strings, rows, chunk_size=32):
+        """
+        Return Neighbours for every query deck, queries are scored <chunk_size> at a time.
+        """
+        neighbours = list()
+        for start in range(0, len(deck_strings), chunk_size):
+            chunk = deck_strings[start:start + chunk_size]
+            scores = self.score_batch([self.query_terms(deck_string) for deck_string in chunk])
+            neighbours.extend(self.neighbours(row, rows) for row in scores)
+        return neighbours
+
+    def vocabulary(self):
+        return self._vocabulary
+
+    def document_frequencies(self):
+        return self.df
+
+    def version(self):
+        return self._version
+
+    def cache_key(self):
+        return f'matrix:{self.version()}:{self.max_query_terms}:{self.k1}:{self.b}'
+
+    def terms(self):
+        return self._terms
+
+    def collection_size(self):
+        return len(self.ids)
+
+
+class LSHBackend(MatrixBackend):
+    """
+    Approximate matrix backend for large corpora: only decks that share a MinHash LSH bucket with the query deck
+    (see lsh.LSHIndex) are scored, at most <max_candidates> per query, so the cost of a query no longer grows with the corpus.
+    More <bands> and a larger <max_candidates> give better recall at the cost of slower queries.
+    With rows = <num_perm> / <bands>, decks above a Jaccard similarity of about (1 / bands) ** (1 / rows) to the query
+    are likely candidates. Decks this similar to a query share few cards, so the defaults use one row per band
+    (threshold 1/128): on the synthetic test corpus, recall@10 against matrix is 0.04 with 32 bands of 4 rows,
+    0.78 with 64 bands of 2 rows and 0.98 with 128 bands of 1 row (see lsh.benchmark).
+    """
+    def __init__(self, directory=None, num_perm=128, bands=128, max_candidates=5000, seed=1, **kwargs):
+        self.num_perm = num_perm
+        self.bands = bands
+        self.max_candidates = max_candidates
+        self.seed = seed
+        super().__init__(directory, **kwargs)
+
+    def _prepare(self):
+        super()._prepare()
+        self.minhash = lsh.MinHash(len(self.cards), self.num_perm, self.seed)
+        version = f'{self._version}-{self.num_perm}-{self.bands}-{self.seed}'
+        if not snapshots.exists('lsh', version):
+            index = lsh.LSHIndex.build(self.minhash, self.indptr, self.indices, self.bands)
+            snapshots.save('lsh', version, {'keys': index.keys, 'order': index.order})
+        arrays, _ = snapshots.load('lsh', version)
+        self.index = lsh.LSHIndex(arrays['keys'], arrays['order'], self.bands)
+
+    def candidates(self, deck_string):
+        return self.index.candidates(self.minhash.signature(self._vocabulary.encode(deck_string.split(' '))), self.max_candidates)
+
+    def score_candidates(self, card_ids, boosts, decks):
+        """
+        Score <decks> against the weighted query cards, like MatrixBackend.score but only for the given decks.
+        """
+        weights = np.zeros(len(self.cards))
+        weights[card_ids] = boosts * self.bm25_idf[card_ids]
+        positions, lengths = csr_positions(self.indptr, decks)
+        rows = np.repeat(np.arange(len(decks)), lengths)
+        return np.bincount(rows, weights=weights[self.indices[positions]] * self.tf_norm[positions], minlength=len(decks))
+
+    def similar_decks_batch(self, deck_strings, rows, chunk_size=None):
+        neighbours = list()
+        for deck_string in deck_strings:
+            decks = self.candidates(deck_string)
+            scores = self.score_candidates(*self.query_terms(deck_string), decks)
+            keep = scores > 0
+            decks, scores = decks[keep], scores[keep]
+            top = np.lexsort((decks, -scores))[:rows]
+            decks, scores = decks[top], scores[top]
+            positions, lengths = csr_positions(self.indptr, decks)
+            indptr = np.concatenate(([0], np.cumsum(lengths)))
+            neighbours.append(Neighbours([self.ids[i] for i in decks], scores, indptr, self.indices[positions].astype(np.int64)))
+        return neighbours
+
+    def similar_decks(self, deck_string, rows):
+        ids, scores, indptr, indices = self.similar_decks_batch([deck_string], rows)[0]
+        return [(deck_id, float(score), [self.cards[i] for i in indices[indptr[j]:indptr[j + 1]]]) for j, (deck_id, score) in enumerate(zip(ids, scores))]
+
+    def cache_key(self):
+        return f'lsh:{self.version()}:{self.max_query_terms}:{self.k1}:{self.b}:{self.num_perm}:{self.bands}:{self.max_candidates}:{self.seed}'
+
+
+class ShardedBackend(MatrixBackend):
+    """
+    Matrix backend with the stored decks partitioned into <n_shards> shards by commander (see shards.assign),
+    each shard with its own postings. A query is sent to the shards of the commanders among its cards first, then,
+    in parallel, to every other shard whose upper bound score (the best term frequency part of every query card in
+    the shard, see _prepare) could reach the last of the best decks found so far; shard results are merged by score.
+    Decks are scored with the statistics of the whole corpus, so a deck has the same score in its shard as in MatrixBackend
+    and the similar decks are exactly those of MatrixBackend, only the number of shards scored depends on the bound.
+    With <exhaustive>, every query goes to every shard at once. With a <bound_scale> below 1 the bounds are scaled down,
+    fewer shards are scored and decks of the other shards can be missed: a trade of recall for speed.
+    """
+    def __init__(self, directory=None, n_shards=8, workers=None, exhaustive=False, bound_scale=1.0, **kwargs):
+        self.n_shards = n_shards
+        self.bound_scale = bound_scale
+        self.workers = workers if workers is not None else n_shards
+        self.exhaustive = exhaustive
+        super().__init__(directory, **kwargs)
+
+    def _prepare(self):
+        super()._prepare()
+        deck_commanders = shards.commanders(self.sequence_ptr, self.sequence)
+        shard_of, self.deck_shards = shards.assign(deck_commanders, self.n_shards)
+        self.commander_shard = np.full(len(self.cards), -1, dtype=np.int64)
+        for commander, shard in shard_of.items():
+            if commander >= 0:
+                self.commander_shard[commander] = shard
+
+        # per shard: its decks (global indices, sorted) and card -> local deck postings, in the order of the global postings
+        shard_of_posting = self.deck_shards[self.postings]
+        card_of_posting = np.repeat(np.arange(len(self.cards)), self.df)
+        self.shard_decks = list()
+        self.shard_postings = list()
+        for shard in range(self.n_shards):
+            decks = np.flatnonzero(self.deck_shards == shard)
+            mask = shard_of_posting == shard
+            ptr = np.concatenate(([0], np.cumsum(np.bincount(card_of_posting[mask], minlength=len(self.cards)))))
+            self.shard_decks.append(decks)
+            self.shard_postings.append((ptr, np.searchsorted(decks, self.postings[mask]), self.postings_tf_norm[mask]))
+
+        # best BM25 term frequency part of every card per shard, bounds the score of any deck of the shard
+        self.shard_max_tf_norm = np.zeros((self.n_shards, len(self.cards)))
+        np.maximum.at(self.shard_max_tf_norm, (shard_of_posting, card_of_posting), self.postings_tf_norm)
+
+    def route(self, card_ids):
+        """
+        Shards of the commanders among <card_ids>, all shards when there are none.
+        """
+        home = np.unique(self.commander_shard[card_ids])
+        home = home[home >= 0]
+        return home.tolist() if len(home) and not self.exhaustive else list(range(self.n_shards))
+
+    def shard_top(self, shard, queries, rows):
+        """
+        The <rows> best decks of <shard> for every query in <queries> (card ids, boosts), as (global deck indices, scores).
+        """
+        ptr, postings, tf_norm = self.shard_postings[shard]
+        decks = self.shard_decks[shard]
+        keys = list()
+        weights = list()
+        for q, (card_ids, boosts) in enumerate(queries):
+            positions, lengths = csr_positions(ptr, card_ids)
+            keys.append(postings[positions] + q * len(decks))
+            weights.append(np.repeat(boosts * self.bm25_idf[card_ids], lengths) * tf_norm[positions])
+        scores = np.bincount(np.concatenate(keys), weights=np.concatenate(weights), minlength=len(queries) * len(decks))
+
+        results = list()
+        for row in scores.reshape(len(queries), len(decks)):
+            top = self.top_decks(row, rows)
+            results.append((decks[top], row[top]))
+        return results
+
+    def bounds(self, card_ids, boosts):
+        """
+        Upper bound of the score of any deck of every shard for the query (card ids, boosts).
+        """
+        return self.shard_max_tf_norm[:, card_ids] @ (boosts * self.bm25_idf[card_ids])
+
+    def _scatter(self, executor, requests, queries, rows, found):
+        # requests: shard -> query indices, shards are scored in parallel and their decks added to found[query]
+        requests = {shard: q for shard, q in requests.items() if q}
+        futures = {shard: executor.submit(self.shard_top, shard, [queries[i] for i in q], rows) for shard, q in requests.items()}
+        for shard, future in futures.items():
+            for i, result in zip(requests[shard], future.result()):
+                found[i].append(result)
+
+    def _fan_out(self, query, visited, results, rows):
+        """
+        Shards not in <visited> that may hold a deck scoring at least the <rows>-th best score of <results>.
+        """
+        scores = np.concatenate([scores for _, scores in results]) if results else np.zeros(0)
+        last = -np.partition(-scores, rows - 1)[rows - 1] if len(scores) >= rows else 0.0
+        bounds = self.bounds(*query)
+        # >=: a deck tied with the last one can still come first in deck order; the margin covers rounding
+        return [shard for shard in range(self.n_shards) if shard not in visited and bounds[shard] > 0 and bounds[shard] * self.bound_scale * (1 + 1e-9) >= last]
+
+    def similar_decks_batch(self, deck_strings, rows, chunk_size=32):
+        """
+        Return Neighbours for every query deck, see the class docstring for the shards a query is sent to.
+        """
+        neighbours = list()
+        with ThreadPoolExecutor(self.workers) as executor:
+            for start in range(0, len(deck_strings), chunk_size):
+                neighbours.extend(self._similar_decks_chunk(executor, deck_strings[start:start + chunk_size], rows))
+        return neighbours
+
+    def _similar_decks_chunk(self, executor, deck_strings, rows):
+        neighbours = list()
+        queries = [self.query_terms(deck_string) for deck_string in deck_strings]
+        visited = [self.route(self._vocabulary.encode(deck_string.split(' '))) for deck_string in deck_strings]
+        found = [list() for _ in queries]
+
+        requests = {shard: [i for i, shards_of_query in enumerate(visited) if shard in shards_of_query] for shard in range(self.n_shards)}
+        self._scatter(executor, requests, queries, rows, found)
+
+        # fan out to the other shards that could hold better decks than the ones found
+        fan_out = [self._fan_out(query, shards_of_query, results, rows) if rows > 0 else [] for query, shards_of_query, results in zip(queries, visited, found)]
+        instrumentation.count('sharded.fan_out', sum(len(shards_of_query) > 0 for shards_of_query in fan_out))
+        requests = {shard: [i for i, shards_of_query in enumerate(fan_out) if shard in shards_of_query] for shard in range(self.n_shards)}
+        self._scatter(executor, requests, queries, rows, found)
+
+        for results in found:
+            decks = np.concatenate([decks for decks, _ in results]) if results else np.zeros(0, dtype=np.int64)
+            scores = np.concatenate([scores for _, scores in results]) if results else np.zeros(0)
+            # merge by score, ties in deck order like MatrixBackend.top_decks
+            top = np.lexsort((decks, -scores))[:rows]
+            decks, scores = decks[top], scores[top]
+            positions, lengths = csr_positions(self.indptr, decks)
+            indptr = np.concatenate(([0], np.cumsum(lengths)))
+            neighbours.append(Neighbours([self.ids[i] for i in decks], scores, indptr, self.indices[positions].astype(np.int64)))
+        return neighbours
+
+    def similar_decks(self, deck_string, rows):
+        ids, scores, indptr, indices = self.similar_decks_batch([deck_string], rows)[0]
+        return [(deck_id, float(score), [self.cards[i] for i in indices[indptr[j]:indptr[j + 1]]]) for j, (deck_id, score) in enumerate(zip(ids, scores))]
+
+    def cache_key(self):
+        return f'sharded:{self.version()}:{self.max_query_terms}:{self.k1}:{self.b}:{self.n_shards}:{self.exhaustive}:{self.bound_scale}'
+
+
+BACKENDS = {
+    'solr': SolrBackend,
+    'matrix': MatrixBackend,
+    'lsh': LSHBackend,
+    'sharded': ShardedBackend,
+}
+
+_instances = dict()
+
+
+def get_backend(backend='solr'):
+    """
+    Return a backend instance, <backend> is either a backend or one of the names in BACKENDS.
+    Backends are created once per process.
+    """
+    if not isinstance(backend, str):
+        return backend
+    if backend not in _instances:
+        _instances[backend] = BACKENDS[backend]()
+    return _instances[backend]
+
+
+def compare_top(expected, actual, rows, rtol=1e-5):
+    """
+    Compare two top <rows> lists of (deck id, score, ...) tuples, scores are equal within <rtol> (Solr scores are float32).
+    Return 'identical' for the same ids in the same order with the same scores, 'ties' when the lists only differ
+    among decks with equal scores: in their order, or in which of the decks tied at the cut-off made the top <rows>.
+    Return 'different' otherwise.
+    """
+    expected_scores = np.array([d[1] for d in expected], dtype=np.float64)
+    actual_scores = np.array([d[1] for d in actual], dtype=np.float64)
+    if len(expected) != len(actual) or not np.allclose(actual_scores, expected_scores, rtol=rtol, atol=0):
+        return 'different'
+    if [d[0] for d in expected] == [d[0] for d in actual]:
+        return 'identical'
+
+    # runs of tied scores must hold the same decks, except the run at the cut-off of a full list
+    tied = np.isclose(expected_scores[1:], expected_scores[:-1], rtol=rtol, atol=0)
+    runs = np.split(np.arange(len(expected)), np.flatnonzero(~tied) + 1)
+    if len(expected) == rows:
+        runs = runs[:-1]
+    for run in runs:
+        if {expected[i][0] for i in run} != {actual[i][0] for i in run}:
+            return 'different'
+    return 'ties'
+
+
+def reconnect():
+    """
+    Give the backends created in this process new connections, call it first thing in a forked worker process.
+    """
+    for backend in _instances.values():
+        if isinstance(backend, SolrBackend):
+            backend.reconnect()
+
+
+def check_parity(deck_ids, rows=10, leave_out_count=25, seed=0, reference='solr', backend='matrix'):
+    """
+    Compare the top <rows> similar decks of two backends on test cases built from the test decks, see compare_top.
+    Return the number of identical rankings, of rankings that only differ among tied decks and the deck ids of the
+    test cases whose rankings differ.
+    """
+    import recommender
+    import utils
+
+    reference = get_backend(reference)
+    backend = get_backend(backend)
+
+    identical = 0
+    ties = 0
+    different = list()
+    for deck_id in deck_ids:
+        deck = utils.import_deck(constants.TEST_DECKS / f'{deck_id}.json')
+        query, _ = recommender.deck_to_testcase(deck, leave_out_count, seed)
+        deck_string = " ".join(sorted(query))
+
+        result = compare_top(reference.similar_decks(deck_string, rows), backend.similar_decks(deck_string, rows), rows)
+        if result == 'identical':
+            identical += 1
+        elif result == 'ties':
+            ties += 1
+        else:
+            different.append(deck_id)
+
+    return identical, ties, different
+
+
+def assert_parity(deck_ids, **parameters):
+    """
+    Raise an AssertionError when the backends return different top decks for any test case, see check_parity.
+    """
+    identical, ties, different = check_parity(deck_ids, **parameters)
+    assert not different, f'{len(different)} of {len(deck_ids)} rankings differ, e.g. test deck {different[0]}'
+    return identical, ties
+
+
+if __name__ == '__main__':
+    deck_ids = sorted(file.stem for file in constants.TEST_DECKS.iterdir())[:200]
+    identical, ties = assert_parity(deck_ids)
+    print(f'identical top-10: {identical} of {len(deck_ids)}, differing only in ties: {ties}')
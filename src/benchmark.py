@@ -0,0 +1,247 @@
+import datetime
+import json
+import os
+import pathlib
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+import backends
+import cache
+import constants
+import metrics
+import recommender
+import synthetic
+import utils
+from solr_stub import SolrStub
+
+RESULTS = pathlib.Path('results/benchmarks')
+# relative slowdown of a benchmark's median that counts as a regression
+THRESHOLD = 0.1
+
+
+def measure(fn, calls=((),), repeat=5):
+    """
+    Time fn(*args) for every args in <calls>, <repeat> times. Return statistics of the seconds per call.
+    """
+    times = list()
+    for _ in range(repeat):
+        for args in calls:
+            start = time.perf_counter()
+            fn(*args)
+            times.append(time.perf_counter() - start)
+    times = np.array(times)
+    return {
+        'median': float(np.median(times)),
+        'mean': float(times.mean()),
+        'min': float(times.min()),
+        'p90': float(np.percentile(times, 90)),
+        'calls': len(times),
+    }
+
+
+def per_item(stats, items):
+    """
+    Divide timings of calls that process <items> items each, e.g. seconds per run -> seconds per test case.
+    """
+    return {key: value / items if key != 'calls' else value for key, value in stats.items()}
+
+
+class Workspace:
+    """
+    Synthetic corpus of <n_decks> decks (see synthetic.DeckGenerator) in a temporary directory that becomes the working directory,
+    so constants.RAW_DECKS, constants.STORED_DECKS, ... point into it. The decks are preprocessed and served by a SolrStub.
+    """
+    def __init__(self, n_decks=5000, seed=0, test_decks=50, leave_out_count=25):
+        self.n_decks = n_decks
+        self.seed = seed
+        self.test_decks = test_decks
+        self.leave_out_count = leave_out_count
+
+    def __enter__(self):
+        import preprocess
+
+        self.cwd = os.getcwd()
+        self.directory = tempfile.TemporaryDirectory()
+        os.chdir(self.directory.name)
+        synthetic.write_raw(constants.RAW_DECKS, self.n_decks, seed=self.seed)
+        preprocess.main()
+
+        self.stub = SolrStub().start()
+        self.solr_url, constants.SOLR_URL = constants.SOLR_URL, self.stub.url
+        self._reset()
+
+        self.test_ids = sorted(file.stem for file in constants.TEST_DECKS.glob('*.json'))[:self.test_decks]
+        self.queries = list()
+        for deck_id in self.test_ids:
+            query, _ = recommender.deck_to_testcase(utils.import_deck(constants.TEST_DECKS / f'{deck_id}.json'), self.leave_out_count, self.seed)
+            self.queries.append(' '.join(sorted(query)))
+        return self
+
+    def _reset(self):
+        # backends and term statistics are per process, don't let them outlive the corpus they were loaded from
+        backends._instances.clear()
+        backends.Terms.refresh()
+
+    def __exit__(self, *exc):
+        self.stub.stop()
+        constants.SOLR_URL = self.solr_url
+        self._reset()
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+
+def bench_sanitize(workspace, repeat):
+    names = list()
+    for file in sorted(constants.RAW_DECKS.glob('*.json'))[:500]:
+        with open(file, 'r') as f:
+            names.extend(json.load(f)['cards'])
+
+    def sanitize_all():
+        utils.sanitize.cache_clear()
+        for name in names:
+            utils.sanitize(name)
+
+    return {'sanitize': per_item(measure(sanitize_all, repeat=repeat), len(names))}
+
+
+def bench_preprocess(workspace, repeat):
+    import preprocess
+    return {'preprocess.main': per_item(measure(preprocess.main, repeat=max(1, repeat // 2)), workspace.n_decks)}
+
+
+def bench_metrics(workspace, repeat):
+    rng = np.random.default_rng(workspace.seed)
+    cards = [f'card-{i}' for i in range(5000)]
+    batch = [(rng.permutation(cards)[:1000].tolist(), set(rng.choice(cards, 25, replace=False).tolist())) for _ in range(64)]
+    return {
+        'metrics.evaluate_batch': per_item(measure(metrics.evaluate_batch, [(batch,)], repeat), len(batch)),
+        'metrics.evaluate': measure(metrics.evaluate, batch[:16], repeat),
+        'recommender.average_precision': measure(recommender.average_precision, batch[:16], repeat),
+    }
+
+
+def bench_recommend(workspace, repeat):
+    results = dict()
+    for backend in ('solr', 'matrix'):
+        recommender.generate_recommendations(workspace.queries[0], backend=backend) # warm up term statistics and vectors
+        calls = [(query, None, 10, False, 1.0, 'no', backend) for query in workspace.queries]
+        results[f'generate_recommendations.{backend}'] = measure(recommender.generate_recommendations, calls, repeat)
+        batch = lambda: recommender.generate_recommendations_batch(workspace.queries, backend=backend)
+        results[f'generate_recommendations_batch.{backend}'] = per_item(measure(batch, repeat=repeat), len(workspace.queries))
+    return results
+
+
+def bench_experiment(workspace, repeat):
+    import experiments
+
+    results = dict()
+    saved = experiments.BACKEND
+    try:
+        for backend in ('solr', 'matrix'):
+            experiments.BACKEND = backend
+            serial = lambda: experiments.run_experiment(experiments.final_results, workspace.test_ids, root_directory='results', name='benchmark', plots='none', resume=False)
+            batched = lambda: experiments.run_experiment(experiments.final_results_batch, workspace.test_ids, root_directory='results', name='benchmark', batch_size=64, plots='none', resume=False)
+            results[f'run_experiment.final_results.{backend}'] = per_item(measure(serial, repeat=max(1, repeat // 2)), len(workspace.test_ids))
+            results[f'run_experiment.final_results_batch.{backend}'] = per_item(measure(batched, repeat=max(1, repeat // 2)), len(workspace.test_ids))
+    finally:
+        experiments.BACKEND = saved
+    return results
+
+
+# every benchmark returns name -> seconds per call, per deck, per query or per test case
+BENCHMARKS = {
+    'sanitize': bench_sanitize,
+    'preprocess': bench_preprocess,
+    'metrics': bench_metrics,
+    'recommend': bench_recommend,
+    'experiment': bench_experiment,
+}
+
+
+def _commit():
+    try:
+        directory = pathlib.Path(__file__).parent
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=directory, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=directory, capture_output=True, text=True).stdout.strip()
+        return commit + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def run(names=None, n_decks=5000, seed=0, repeat=5, test_decks=50):
+    """
+    Run the <names> benchmarks (default all of BENCHMARKS) on a synthetic corpus of <n_decks> decks, offline:
+    Solr is replaced by a SolrStub and the result cache is disabled.
+    Return a json-serializable dict with the timings (in seconds, see measure) and where they were measured.
+    """
+    names = list(BENCHMARKS) if names is None else names
+    results = {
+        'commit': _commit(),
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'parameters': {'n_decks': n_decks, 'seed': seed, 'repeat': repeat, 'test_decks': test_decks},
+        'benchmarks': dict(),
+    }
+    with cache.disabled(), Workspace(n_decks, seed, test_decks) as workspace:
+        for name in names:
+            print(f'{name}...', file=sys.stderr)
+            results['benchmarks'].update(BENCHMARKS[name](workspace, repeat))
+    return results
+
+
+def save(results, directory=RESULTS):
+    """
+    Write <results> of run to <directory>/<commit>.json, return the file.
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+    file = directory / f'{results["commit"]}.json'
+    with open(file, 'w') as f:
+        json.dump(results, f, indent=2)
+    return file
+
+
+def load(file):
+    with open(file, 'r') as f:
+        return json.load(f)
+
+
+def compare(baseline, current, threshold=THRESHOLD, statistic='median'):
+    """
+    Compare the benchmarks two runs have in common. Return (name, baseline, current, ratio) of every benchmark
+    and the names of the regressions: benchmarks whose <statistic> grew by more than <threshold> (0.1 = 10% slower).
+    """
+    rows = list()
+    regressions = list()
+    for name, stats in current['benchmarks'].items():
+        if name not in baseline['benchmarks']:
+            continue
+        before, after = baseline['benchmarks'][name][statistic], stats[statistic]
+        ratio = after / before if before > 0 else float('inf')
+        rows.append((name, before, after, ratio))
+        if ratio > 1 + threshold:
+            regressions.append(name)
+    return rows, regressions
+
+
+def print_comparison(rows, regressions):
+    width = max((len(name) for name, *_ in rows), default=0)
+    for name, before, after, ratio in rows:
+        flag = 'REGRESSION' if name in regressions else ''
+        print(f'{name:<{width}}  {before * 1e6:12.1f} us  {after * 1e6:12.1f} us  {ratio:6.2f}x  {flag}')
+
+
+if __name__ == '__main__':
+    # python benchmark.py                          -> run all benchmarks, write results/benchmarks/<commit>.json
+    # python benchmark.py baseline.json current.json -> compare two runs, exit status 1 on a regression
+    if len(sys.argv) == 3:
+        rows, regressions = compare(load(sys.argv[1]), load(sys.argv[2]))
+        print_comparison(rows, regressions)
+        sys.exit(1 if regressions else 0)
+    print(save(run()))
@@ -0,0 +1,150 @@
+import contextlib
+import hashlib
+import json
+import os
+import sqlite3
+from collections import OrderedDict
+
+# bump when a change to recommender or the backends changes the rankings, old cache entries then stop matching
+RANKING_VERSION = 2
+
+
+def cache_key(deck_string, parameters, backend):
+    """
+    Key of the recommendations of a query deck: a hash of its sorted cards, the scoring <parameters> and the backend and its index version.
+    """
+    cards = sorted(card for card in deck_string.split(' ') if card)
+    data = json.dumps([RANKING_VERSION, backend.cache_key(), parameters, cards], sort_keys=True)
+    return hashlib.sha1(data.encode()).hexdigest()
+
+
+class ResultCache:
+    """
+    Two-level cache of full recommendation rankings: an in-memory LRU of <max_entries> rankings
+    and, with a <path>, a sqlite store of at most <max_disk_entries> rankings shared by processes and runs.
+    """
+    def __init__(self, max_entries=4096, path=None, max_disk_entries=1_000_000):
+        self.max_entries = max_entries
+        self.path = path
+        self.max_disk_entries = max_disk_entries
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._connection = None
+        self._pid = None
+
+    def _db(self):
+        # a sqlite connection can't be shared with forked worker processes
+        if self._connection is None or self._pid != os.getpid():
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._connection = sqlite3.connect(self.path, timeout=60)
+            self._connection.execute('CREATE TABLE IF NOT EXISTS rankings (key TEXT PRIMARY KEY, ranking TEXT, used REAL)')
+            self._pid = os.getpid()
+        return self._connection
+
+    def _remember(self, key, ranking):
+        self.memory[key] = ranking
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def get(self, key):
+        """
+        Cached ranking of <key>, or None.
+        """
+        ranking = self.memory.get(key)
+        if ranking is not None:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return ranking
+
+        if self.path is not None:
+            row = self._db().execute('SELECT ranking FROM rankings WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                ranking = json.loads(row[0])
+                self._remember(key, ranking)
+                self.disk_hits += 1
+                return ranking
+
+        self.misses += 1
+        return None
+
+    def put_many(self, items):
+        """
+        Cache a list of (key, ranking) pairs.
+        """
+        for key, ranking in items:
+            self._remember(key, ranking)
+        if self.path is None or not items:
+            return
+
+        db = self._db()
+        with db:
+            db.executemany("INSERT OR REPLACE INTO rankings VALUES (?, ?, julianday('now'))", [(key, json.dumps(ranking)) for key, ranking in items])
+        self._puts += len(items)
+        if self._puts >= 1024:
+            self._puts = 0
+            self._evict()
+
+    def put(self, key, ranking):
+        self.put_many([(key, ranking)])
+
+    def _evict(self):
+        db = self._db()
+        with db:
+            db.execute('DELETE FROM rankings WHERE key IN (SELECT key FROM rankings ORDER BY used DESC LIMIT -1 OFFSET ?)', (self.max_disk_entries,))
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            'entries': len(self.memory),
+        }
+
+    def clear(self):
+        self.memory.clear()
+        if self.path is not None:
+            with self._db() as db:
+                db.execute('DELETE FROM rankings')
+
+
+_cache = None
+
+
+def configure(max_entries=4096, path=None, max_disk_entries=1_000_000):
+    """
+    Enable the result cache of recommender.generate_recommendations, with <path> (e.g. constants.RESULTS_CACHE) on disk as well.
+    """
+    global _cache
+    _cache = ResultCache(max_entries, path, max_disk_entries)
+    return _cache
+
+
+def disable():
+    global _cache
+    _cache = None
+
+
+def get_cache():
+    """
+    The configured result cache, or None when caching is disabled.
+    """
+    return _cache
+
+
+@contextlib.contextmanager
+def disabled():
+    """
+    Temporarily disable the result cache, e.g. to time the recommenders.
+    """
+    global _cache
+    saved, _cache = _cache, None
+    try:
+        yield
+    finally:
+        _cache = saved
@@ -3,3 +3,8 @@ import pathlib
 RAW_DECKS = pathlib.Path('Data/decks')
 TEST_DECKS = pathlib.Path('Data/processed_test_decks')
 STORED_DECKS = pathlib.Path('Data/processed_decks')
+CACHE = pathlib.Path('Data/cache')
+RESULTS_CACHE = CACHE / 'results.sqlite'
+MANIFEST = pathlib.Path('Data/manifest.json')
+
+SOLR_URL = 'http://localhost:8983/solr/decks'
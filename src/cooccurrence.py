@@ -0,0 +1,172 @@
+import numpy as np
+
+import backends
+import constants
+import corpus
+import snapshots
+from vocabulary import Vocabulary
+
+WEIGHTINGS = ('count', 'pmi', 'idf')
+
+# arrays of a co-occurrence file (see corpus.write):
+#   cards    uint8    card vocabulary of the stored decks, see vocabulary.Vocabulary.to_array
+#   indptr   int64    CSR row offsets, card i co-occurs with indices[indptr[i]:indptr[i + 1]]
+#   indices  uint16   sorted ids of the co-occurring cards
+#   count    float32  number of stored decks containing both cards
+#   pmi      float32  positive pointwise mutual information, max(0, log(count * N / (df_a * df_b)))
+#   idf      float32  count weighted by the idf of the co-occurring card, count * log(N / df_b)
+
+
+def index_path(directory):
+    """
+    Co-occurrence file of a processed deck directory, Data/processed_decks -> Data/processed_decks.cooccurrence
+    """
+    return directory.with_suffix('.cooccurrence')
+
+
+def count_pairs(indptr, indices, n_cards, min_count=1, max_partners=None, block_cells=2**24, chunk_size=2**15):
+    """
+    Count the decks every pair of different cards occurs in, as a card x card CSR matrix (indptr, indices, counts),
+    pairs in less than <min_count> decks are dropped and with <max_partners> only the most frequent partners of every card are kept.
+    Rows are counted in blocks of dense block_cells counters, so memory doesn't depend on the number of pairs
+    of the whole corpus; the entries of a block are expanded <chunk_size> entries at a time.
+    """
+    indptr = np.asarray(indptr, dtype=np.int64)
+    cards = np.asarray(indices, dtype=np.int64)
+    deck_of_entry = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+    block_rows = max(1, block_cells // max(n_cards, 1))
+
+    row_lengths, columns, counts = list(), list(), list()
+    for first in range(0, n_cards, block_rows):
+        last = min(first + block_rows, n_cards)
+        selected = np.flatnonzero((cards >= first) & (cards < last))
+        block = np.zeros((last - first) * n_cards, dtype=np.int64)
+        for start in range(0, len(selected), chunk_size):
+            entries = selected[start:start + chunk_size]
+            # every selected card paired with every card of the same deck
+            partners, lengths = backends.csr_positions(indptr, deck_of_entry[entries])
+            a, b = np.repeat(cards[entries], lengths), cards[partners]
+            block += np.bincount((a - first) * n_cards + b, minlength=len(block))
+
+        block = block.reshape(last - first, n_cards)
+        # pairs of a card with itself hold its document frequency
+        block[np.arange(last - first), np.arange(first, last)] = 0
+        row, column = np.nonzero(block >= max(min_count, 1))
+        if max_partners is not None:
+            # rank the partners of every card by count, ties in card order
+            order = np.lexsort((-block[row, column], row))
+            starts = np.concatenate(([0], np.cumsum(np.bincount(row, minlength=last - first))))
+            keep = np.sort(order[np.arange(len(order)) - starts[row[order]] < max_partners])
+            row, column = row[keep], column[keep]
+        row_lengths.append(np.bincount(row, minlength=last - first))
+        columns.append(column.astype(np.uint16))
+        counts.append(block[row, column].astype(np.int32))
+
+    indptr = np.concatenate(([0], np.cumsum(np.concatenate(row_lengths)))).astype(np.int64)
+    return indptr, np.concatenate(columns), np.concatenate(counts)
+
+
+def build(directory=None, file=None, min_count=1, max_partners=None):
+    """
+    Build the card x card co-occurrence file of the stored decks in <directory>, see count_pairs for <min_count> and <max_partners>.
+    Fewer partners per card make item-based recommendations faster.
+    Document frequencies are those of the matrix backend, the same statistics Solr reports (see backends.Terms).
+    """
+    backend = backends.MatrixBackend(directory)
+    if file is None:
+        file = index_path(backend.directory)
+    n_cards = len(backend.cards)
+    n_decks = backend.collection_size()
+
+    indptr, indices, counts = count_pairs(backend.indptr, backend.indices, n_cards, min_count, max_partners)
+    df = backend.df.astype(np.float32)
+    df_a = np.repeat(df, np.diff(indptr))
+    df_b = df[indices]
+    counts = counts.astype(np.float32)
+
+    arrays = {
+        'cards': backend.vocabulary().to_array(),
+        'indptr': indptr,
+        'indices': indices,
+        'count': counts,
+        'pmi': np.maximum(0, np.log(counts * np.float32(n_decks) / (df_a * df_b))),
+        'idf': counts * np.log(np.float32(n_decks) / df_b),
+    }
+    corpus.write(file, arrays, {'version': backend.version(), 'collection_size': n_decks, 'min_count': min_count, 'max_partners': max_partners})
+    return file
+
+
+class CooccurrenceIndex:
+    """
+    Item-based recommender on a memory-mapped co-occurrence file: a card's score is the sum of its co-occurrence
+    weights with the cards of the query deck, no similar decks are retrieved.
+    """
+    def __init__(self, file):
+        self.file = file
+        self.arrays, self.meta = corpus.read(file)
+        self.vocabulary = Vocabulary.from_array(self.arrays['cards'])
+        self.indptr = self.arrays['indptr']
+        self.indices = self.arrays['indices']
+
+    def scores(self, card_ids, weighting='pmi'):
+        positions, _ = backends.csr_positions(self.indptr, card_ids.astype(np.int64))
+        return np.bincount(self.indices[positions], weights=self.arrays[weighting][positions], minlength=len(self.vocabulary))
+
+    def recommend_batch(self, deck_strings, k=None, weighting='pmi'):
+        """
+        Generate k card recommendations for every deck in <deck_strings>, with one of the WEIGHTINGS.
+        """
+        if weighting not in WEIGHTINGS:
+            raise ValueError(f'Unknown weighting: {weighting}')
+
+        recommendations = list()
+        for deck_string in deck_strings:
+            query = self.vocabulary.encode(deck_string.split(' '))
+            scores = self.scores(query, weighting)
+            scores[query] = 0
+            candidates = np.flatnonzero(scores > 0)
+            ranking = candidates[np.argsort(-scores[candidates], kind='stable')]
+            if k is not None:
+                ranking = ranking[:k]
+            recommendations.append(self.vocabulary.decode(ranking))
+        return recommendations
+
+    def recommend(self, deck_string, k=None, weighting='pmi'):
+        return self.recommend_batch([deck_string], k, weighting)[0]
+
+
+_indexes = dict()
+
+
+def current_version(directory):
+    """
+    Version of the stored decks the matrix backend would build an index from (see MatrixBackend._load):
+    that of an up to date packed corpus, otherwise the version of the directory.
+    """
+    packed = corpus.open_corpus(directory)
+    return packed.meta['version'] if packed is not None else snapshots.directory_version(directory)
+
+
+def open_index(directory=None):
+    """
+    Co-occurrence index of <directory> (default constants.STORED_DECKS), built on first use and rebuilt (with the same
+    min_count and max_partners) when it was built from another version of the stored decks. Without <directory>,
+    e.g. when only the index is deployed, the index is used as is. Indexes are opened once per process.
+    """
+    directory = directory if directory is not None else constants.STORED_DECKS
+    file = index_path(directory)
+    if file not in _indexes:
+        if not file.exists():
+            build(directory, file)
+        index = CooccurrenceIndex(file)
+        if directory.is_dir() and index.meta['version'] != current_version(directory):
+            meta = index.meta
+            del index
+            build(directory, file, meta['min_count'], meta['max_partners'])
+            index = CooccurrenceIndex(file)
+        _indexes[file] = index
+    return _indexes[file]
+
+
+if __name__ == '__main__':
+    print(f'{constants.STORED_DECKS} -> {build()}')
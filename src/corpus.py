@@ -0,0 +1,277 @@
+import json
+import os
+import struct
+import numpy as np
+
+import snapshots
+from vocabulary import Vocabulary
+
+MAGIC = b'DECKCORP'
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+
+# arrays of a packed corpus:
+#   ids      uint8   deck ids, see snapshots.encode_strings
+#   cards    uint8   card vocabulary, see vocabulary.Vocabulary.to_array
+#   indptr   int64   CSR row offsets, deck i holds indices[indptr[i]:indptr[i + 1]]
+#   indices  uint16  sorted card ids of every deck
+#   counts   uint16  how often every card occurs in its deck
+#   sequence_ptr, sequence   the card ids of every deck in their original order, for utils.import_deck
+
+
+def iter_decks(directory):
+    """
+    Yield (deck id, cards) for every processed deck in <directory>, in file name order.
+    Decks are either json files of one deck or json lines shards, see preprocess.main.
+    """
+    for file in sorted(list(directory.glob('*.json')) + list(directory.glob('*.jsonl'))):
+        with open(file, 'r') as f:
+            if file.suffix == '.jsonl':
+                records = (json.loads(line) for line in f if line.strip())
+            else:
+                records = [json.load(f)]
+            for data in records:
+                yield data['id'], data['cards'].split(' ')
+
+
+def read_decks(decks, vocabulary=None):
+    """
+    Build the corpus arrays of an iterable of (deck id, cards), card ids are assigned by <vocabulary> if given.
+    """
+    vocabulary = vocabulary if vocabulary is not None else Vocabulary()
+    ids = list()
+    indices = list()
+    counts = list()
+    sequence = list()
+    for deck_id, cards in decks:
+        sequence.append(np.array([vocabulary.add(card) for card in cards if card], dtype=np.uint16))
+        # rows hold sorted card ids
+        deck_ids, deck_counts = np.unique(sequence[-1], return_counts=True)
+        indices.append(deck_ids)
+        counts.append(deck_counts.astype(np.uint16))
+        ids.append(deck_id)
+
+    return {
+        'ids': snapshots.encode_strings(ids),
+        'cards': vocabulary.to_array(),
+        'indptr': np.concatenate(([0], np.cumsum([len(i) for i in indices]))).astype(np.int64),
+        'indices': np.concatenate(indices) if indices else np.zeros(0, dtype=np.uint16),
+        'counts': np.concatenate(counts) if counts else np.zeros(0, dtype=np.uint16),
+        'sequence_ptr': np.concatenate(([0], np.cumsum([len(s) for s in sequence]))).astype(np.int64),
+        'sequence': np.concatenate(sequence) if sequence else np.zeros(0, dtype=np.uint16),
+    }
+
+
+def write(file, arrays, meta=None):
+    """
+    Write a dict of arrays to a single file: magic, header length, json header and the raw arrays, 64 byte aligned.
+    """
+    header = {'format': FORMAT_VERSION, 'meta': meta or dict(), 'arrays': dict()}
+    offset = 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        header['arrays'][name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+
+    encoded = json.dumps(header).encode()
+    start = -(-(len(MAGIC) + 8 + len(encoded)) // ALIGNMENT) * ALIGNMENT
+
+    tmp = file.with_name(file.name + '.tmp')
+    with open(tmp, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(encoded)))
+        f.write(encoded)
+        for name, array in arrays.items():
+            f.seek(start + header['arrays'][name]['offset'])
+            f.write(np.ascontiguousarray(array).tobytes())
+        f.truncate(start + offset)
+    tmp.replace(file)
+
+
+def corpus_path(directory):
+    """
+    Packed corpus file of a processed deck directory, Data/processed_decks -> Data/processed_decks.corpus
+    """
+    return directory.with_suffix('.corpus')
+
+
+def pack(directory, file=None):
+    """
+    Convert a directory of processed decks (json files or shards) into a packed corpus file.
+    """
+    if file is None:
+        file = corpus_path(directory)
+    write(file, read_decks(iter_decks(directory)), {'source': str(directory), 'version': snapshots.directory_version(directory), 'mtime_ns': directory.stat().st_mtime_ns})
+    _corpora.pop(file, None)
+    return file
+
+
+def update(directory, removed, added):
+    """
+    Update the packed corpus of <directory> after some of its decks changed, without reading the other decks again:
+    drop the decks with an id in <removed> and append the (deck id, cards) of <added>, a replaced deck is in both.
+    Appended decks come last, like documents re-added to Solr. Cards no deck holds any more are dropped from the vocabulary.
+    """
+    file = corpus_path(directory)
+    arrays, meta = read(file)
+    removed = set(removed)
+    keep = np.array([deck_id not in removed for deck_id in snapshots.decode_strings(arrays['ids'])], dtype=bool)
+    ids = [deck_id for deck_id, k in zip(snapshots.decode_strings(arrays['ids']), keep) if k]
+
+    vocabulary = Vocabulary.from_array(arrays['cards'])
+    new = read_decks(added, vocabulary)
+    ids.extend(snapshots.decode_strings(new['ids']))
+
+    updated = dict()
+    for ptr, values in (('indptr', ('indices', 'counts')), ('sequence_ptr', ('sequence',))):
+        lengths = np.diff(arrays[ptr])
+        kept = np.repeat(keep, lengths)
+        updated[ptr] = np.concatenate(([0], np.cumsum(np.concatenate((lengths[keep], np.diff(new[ptr])))))).astype(np.int64)
+        for name in values:
+            updated[name] = np.concatenate((arrays[name][kept], new[name])).astype(np.uint16)
+
+    # renumber the cards that are still used, in their current order
+    used = np.zeros(len(vocabulary), dtype=bool)
+    used[updated['indices']] = True
+    renumber = (np.cumsum(used) - 1).astype(np.uint16)
+    updated['indices'] = renumber[updated['indices']]
+    updated['sequence'] = renumber[updated['sequence']]
+
+    del arrays
+    write(file, {
+        'ids': snapshots.encode_strings(ids),
+        'cards': Vocabulary([card for card, u in zip(vocabulary.cards, used) if u]).to_array(),
+        'indptr': updated['indptr'],
+        'indices': updated['indices'],
+        'counts': updated['counts'],
+        'sequence_ptr': updated['sequence_ptr'],
+        'sequence': updated['sequence'],
+    }, dict(meta, version=snapshots.directory_version(directory), mtime_ns=directory.stat().st_mtime_ns))
+    _corpora.pop(file, None)
+    return file
+
+
+def read(file):
+    """
+    Memory-map a file written by write, return the dict of arrays and the meta dict.
+    """
+    data = np.memmap(file, dtype=np.uint8, mode='r')
+    if bytes(data[:len(MAGIC)]) != MAGIC:
+        raise ValueError(f'{file} is not a packed deck corpus')
+    (length,) = struct.unpack('<Q', bytes(data[len(MAGIC):len(MAGIC) + 8]))
+    header = json.loads(bytes(data[len(MAGIC) + 8:len(MAGIC) + 8 + length]))
+    start = -(-(len(MAGIC) + 8 + length) // ALIGNMENT) * ALIGNMENT
+
+    arrays = dict()
+    for name, spec in header['arrays'].items():
+        dtype = np.dtype(spec['dtype'])
+        count = int(np.prod(spec['shape']))
+        offset = start + spec['offset']
+        arrays[name] = data[offset:offset + count * dtype.itemsize].view(dtype).reshape(spec['shape'])
+    return arrays, header['meta']
+
+
+class Corpus:
+    """
+    Read-only view on a packed corpus file, the arrays are memory-mapped so processes share them zero-copy.
+    """
+    def __init__(self, file):
+        self.file = file
+        self.arrays, self.meta = read(file)
+
+        self.indptr = self.arrays['indptr']
+        self.indices = self.arrays['indices']
+        self.counts = self.arrays['counts']
+        self._ids = None
+        self._id_index = None
+        self._vocabulary = None
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    @property
+    def ids(self):
+        if self._ids is None:
+            self._ids = snapshots.decode_strings(self.arrays['ids'])
+        return self._ids
+
+    @property
+    def vocabulary(self):
+        if self._vocabulary is None:
+            self._vocabulary = Vocabulary.from_array(self.arrays['cards'])
+        return self._vocabulary
+
+    def _id_map(self):
+        if self._id_index is None:
+            self._id_index = {deck_id: i for i, deck_id in enumerate(self.ids)}
+        return self._id_index
+
+    def index(self, deck_id):
+        return self._id_map()[deck_id]
+
+    def __contains__(self, deck_id):
+        return deck_id in self._id_map()
+
+    def deck_ids(self, index):
+        """
+        Sorted card ids of the deck at <index>.
+        """
+        return self.indices[self.indptr[index]:self.indptr[index + 1]]
+
+    def deck(self, deck_id):
+        """
+        Card names of a deck, like utils.import_deck.
+        """
+        index = self.index(deck_id)
+        sequence_ptr = self.arrays['sequence_ptr']
+        return self.vocabulary.decode(self.arrays['sequence'][sequence_ptr[index]:sequence_ptr[index + 1]])
+
+
+_corpora = dict()
+
+
+def mark_changed(directory):
+    """
+    Record that decks of <directory> were written, a packed corpus of it is stale from now on (see is_current).
+    Writers that rewrite deck files in place call it, rewriting a file doesn't change the directory's modification time.
+    """
+    os.utime(directory)
+
+
+def is_current(packed, directory):
+    """
+    Whether <packed> was packed from the current contents of <directory>: the directory's modification time is the one
+    recorded by pack or update, so opening a corpus costs one stat. A corpus without its directory is used as is.
+    """
+    if not directory.is_dir():
+        return True
+    if 'mtime_ns' not in packed.meta:
+        # packed before modification times were recorded
+        return packed.meta.get('version') == snapshots.directory_version(directory)
+    return packed.meta['mtime_ns'] == directory.stat().st_mtime_ns
+
+
+def open_corpus(directory):
+    """
+    Packed corpus of <directory>, or None if it has not been packed or <directory> changed since it was packed
+    (then the decks are read from <directory> until it is packed again). Corpora are opened once per process.
+    """
+    file = corpus_path(directory)
+    if file not in _corpora:
+        packed = Corpus(file) if file.exists() else None
+        _corpora[file] = packed if packed is not None and is_current(packed, directory) else None
+    return _corpora[file]
+
+
+def refresh():
+    """
+    Forget the opened corpora, e.g. after packing or preprocessing again in this process.
+    """
+    _corpora.clear()
+
+
+if __name__ == '__main__':
+    import constants
+
+    for directory in (constants.STORED_DECKS, constants.TEST_DECKS):
+        print(f'{directory} -> {pack(directory)}')
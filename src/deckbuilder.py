@@ -0,0 +1,137 @@
+from collections import Counter
+import numpy as np
+
+import backends
+import recommender
+
+
+class DeckBuilder:
+    """
+    Incremental version of recommender.generate_recommendations for a deck that changes one card at a time,
+    on the matrix backend (see backends.MatrixBackend).
+    The similarity of every stored deck is kept as state and only updated along the postings of the query cards
+    that change, instead of scoring the whole query again.
+    """
+    def __init__(self, cards=(), similar_decks_count=10, use_deck_score=False, discount_factor=1.0, calculate_df_factor='no', backend='matrix'):
+        self.backend = backends.get_backend(backend)
+        if not isinstance(self.backend, backends.MatrixBackend):
+            raise ValueError('DeckBuilder needs the postings of the matrix backend')
+        self.similar_decks_count = similar_decks_count
+        self.use_deck_score = use_deck_score
+        self.discount_factor = discount_factor
+        self.factors = recommender.df_factors(calculate_df_factor, self.backend.df, self.backend.collection_size())
+
+        n_decks = len(self.backend.ids)
+        self.cards = Counter() # card name -> count in the deck
+        self.query = dict() # query card id -> tf * idf, see MatrixBackend.query_terms
+        self.terms = np.zeros(0, dtype=np.int64) # query card ids, best first
+        # BM25 score of every stored deck times the best query card's tf * idf and the number of query cards it contains
+        self.unnormalized = np.zeros(n_decks)
+        self.matches = np.zeros(n_decks, dtype=np.int64)
+        self._neighbours = None
+        self._card_scores = None
+        self._ranking = None
+
+        for card in cards:
+            self.add_card(card)
+
+    @property
+    def deck(self):
+        return list(self.cards.elements())
+
+    def add_card(self, card):
+        self.cards[card] += 1
+        self._update_query()
+
+    def remove_card(self, card):
+        if self.cards[card] == 0:
+            raise ValueError(f'{card} is not in the deck')
+        self.cards[card] -= 1
+        if self.cards[card] == 0:
+            del self.cards[card]
+        self._update_query()
+
+    def _update_query(self):
+        backend = self.backend
+        self._ranking = None
+        tf = {card: count for card, count in self.cards.items() if card in backend.card_index}
+        # ties are broken alphabetically, like MatrixBackend.query_terms
+        terms = sorted(tf, key=lambda card: (-tf[card] * backend.classic_idf[backend.card_index[card]], card))[:backend.max_query_terms]
+        query = {backend.card_index[card]: tf[card] * backend.classic_idf[backend.card_index[card]] for card in terms}
+
+        # only the postings of query cards that entered, left or changed weight are touched
+        changed = [i for i in query.keys() | self.query.keys() if query.get(i, 0.0) != self.query.get(i, 0.0)]
+        if changed:
+            changed = np.array(sorted(changed), dtype=np.int64)
+            deltas = np.array([query.get(i, 0.0) - self.query.get(i, 0.0) for i in changed])
+            entered = np.array([(i in query) - (i in self.query) for i in changed])
+            positions, lengths = backends.csr_positions(backend.postings_ptr, changed)
+            decks = backend.postings[positions]
+            np.add.at(self.unnormalized, decks, np.repeat(deltas * backend.bm25_idf[changed], lengths) * backend.postings_tf_norm[positions])
+            np.add.at(self.matches, decks, np.repeat(entered, lengths))
+            self._neighbours = None
+        self.query = query
+        self.terms = np.array(list(query), dtype=np.int64)
+
+    def scores(self):
+        """
+        Similarity of every stored deck to the deck, MatrixBackend.score up to rounding.
+        """
+        if not self.query:
+            return np.zeros(len(self.unnormalized))
+        return np.where(self.matches > 0, self.unnormalized / max(self.query.values()), 0.0)
+
+    def _exact_scores(self, decks):
+        # score <decks> with the same operations in the same order as MatrixBackend.score_batch, so ties break the same way
+        backend = self.backend
+        scores = np.array([self.query[i] for i in self.terms])
+        weights = (scores / scores[0]) * backend.bm25_idf[self.terms]
+        exact = np.zeros(len(decks))
+        for card, weight in zip(self.terms, weights):
+            start, end = backend.postings_ptr[card], backend.postings_ptr[card + 1]
+            found = np.minimum(np.searchsorted(backend.postings[start:end], decks), end - start - 1)
+            hit = backend.postings[start + found] == decks
+            exact[hit] += weight * backend.postings_tf_norm[start + found[hit]]
+        return exact
+
+    def neighbours(self):
+        """
+        The similar decks, like MatrixBackend.neighbours.
+        """
+        if self._neighbours is None:
+            rows = self.similar_decks_count
+            estimate = self.scores()
+            candidates = np.flatnonzero(self.matches > 0)
+            if rows < len(candidates):
+                # the incremental scores can be off by rounding, so every deck close to the cut-off is scored exactly
+                cutoff = -np.partition(-estimate[candidates], rows - 1)[rows - 1]
+                candidates = candidates[estimate[candidates] >= cutoff - 1e-9 * max(abs(cutoff), 1.0)]
+            scores = np.zeros(len(estimate))
+            if len(candidates):
+                scores[candidates] = self._exact_scores(candidates)
+            self._neighbours = self.backend.neighbours(scores, rows)
+            self._card_scores = None
+        return self._neighbours
+
+    def top_k(self, k=None):
+        """
+        The k best recommendations for the deck, the same ranking as recommender.generate_recommendations.
+        Card scores are only recalculated when the similar decks changed.
+        """
+        neighbours = self.neighbours()
+        n_cards = len(self.backend.cards)
+        if self._card_scores is None:
+            deck_weights = recommender._deck_weights(neighbours.scores, self.use_deck_score, self.discount_factor)
+            weights = np.repeat(deck_weights, np.diff(neighbours.indptr)) * self.factors[neighbours.indices]
+            self._card_scores = np.bincount(neighbours.indices, weights=weights, minlength=n_cards)
+            self._present = np.bincount(neighbours.indices, minlength=n_cards) > 0
+            self._ranking = None
+
+        if self._ranking is None:
+            present = self._present.copy()
+            present[self.backend.vocabulary().encode(self.cards)] = False
+            candidates = np.flatnonzero(present)
+            self._ranking = candidates[np.argsort(-self._card_scores[candidates], kind='stable')]
+
+        ranking = self._ranking if k is None else self._ranking[:k]
+        return self.backend.vocabulary().decode(ranking)
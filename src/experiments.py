@@ -1,20 +1,132 @@
 import pathlib
 import random
 import math
-from collections import Counter
-import matplotlib.pyplot as plt
+import time
+import functools
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 
+import backends
+import cache
 import constants
+import cooccurrence
+import corpus
+import instrumentation
 import utils
 import recommender
+import metrics
+import results_store
+import plots as plots_module
 
+# retrieval backend used by all experiments, see backends.BACKENDS
+BACKEND = 'solr'
+
+# files of instrumented experiments, next to summary.txt (see run_experiment)
+TIMINGS_FILE = 'timings.txt'
+PROFILE_FILE = 'profile.txt'
+PROFILES = 'profiles'
+
+# sorted, so random.sample picks the same decks whether the test decks are packed or not
 TEST_DECKS_IDS = list()
-for deck in constants.TEST_DECKS.iterdir():
-    TEST_DECKS_IDS.append(str(deck)[-27:-5])
+if corpus.open_corpus(constants.TEST_DECKS) is not None:
+    TEST_DECKS_IDS.extend(sorted(corpus.open_corpus(constants.TEST_DECKS).ids))
+else:
+    for deck in sorted(constants.TEST_DECKS.iterdir()):
+        TEST_DECKS_IDS.append(str(deck)[-27:-5])
+
+
+def _test_cases(fn, cases, batch_size, profile_rate=0.0, profile_folder=None):
+    """
+    Yield (deck id, seed, results) for every (deck id, seed) test case.
+    With a <batch_size>, <fn> takes lists of decks and seeds and is called once per <batch_size> test cases.
+    A <profile_rate> sample of the calls of <fn> is profiled to <profile_folder>/<deck id>-<seed>.prof, see instrumentation.Profile.
+    """
+    def call(key, *args):
+        profile = profile_folder / f'{key}.prof' if instrumentation.sampled(key, profile_rate) else None
+        start = time.perf_counter()
+        with instrumentation.Profile(profile):
+            results = fn(*args)
+        return results, time.perf_counter() - start
+
+    if batch_size is None:
+        for deck_id, seed in cases:
+            with instrumentation.timer('experiment.import_deck'):
+                deck = utils.import_deck(constants.TEST_DECKS / f'{deck_id}.json')
+            results, seconds = call(f'{deck_id}-{seed}', deck, seed)
+            instrumentation.record('experiment.test_case', seconds)
+            yield deck_id, seed, results
+        return
+
+    for start in range(0, len(cases), batch_size):
+        batch = cases[start:start + batch_size]
+        with instrumentation.timer('experiment.import_deck'):
+            decks = [utils.import_deck(constants.TEST_DECKS / f'{deck_id}.json') for deck_id, _ in batch]
+        results, seconds = call(f'{batch[0][0]}-{batch[0][1]}', decks, [seed for _, seed in batch])
+        for _ in batch:
+            instrumentation.record('experiment.test_case', seconds / len(batch))
+        for (deck_id, seed), result in zip(batch, results):
+            yield deck_id, seed, result
+
+
+def _evaluate_test_case(results, rankings):
+    """
+    Calculate the metrics (see metrics.METRICS) for every key of a test case.
+    Return a row (key, metric values, relevance vector, number of relevant cards, ranking) per key for the result store,
+    the ranking is only kept with <rankings>.
+    """
+    # calculate metrics for all keys at once
+    with instrumentation.timer('experiment.metrics'):
+        values, rel = metrics.evaluate_batch(list(results.values()))
+
+    rows = list()
+    for row, (key, value) in enumerate(results.items()):
+        recommendations, relevant_cards = value
+        metric_values = tuple(float(values[metric][row]) for metric in metrics.METRICS)
+        rows.append((key, metric_values, rel[row, :len(recommendations)], len(relevant_cards), list(recommendations) if rankings else None))
+    return rows
+
+
+def _run_shard(fn, cases, batch_size, parent_folder, profile_rate=0.0, rankings=False):
+    """
+    Evaluate a list of test cases, return (deck id, seed, rows) for every test case (see _evaluate_test_case)
+    and the instrumentation recorded meanwhile (see instrumentation.collect).
+    """
+    shard = list()
+    for deck_id, seed, results in _test_cases(fn, cases, batch_size, profile_rate, parent_folder / PROFILES):
+        shard.append((deck_id, seed, _evaluate_test_case(results, rankings)))
+    return shard, instrumentation.collect()
+
+
+def _init_worker(backend, cached, cache_path, instrumented):
+    global BACKEND
+    BACKEND = backend
+    # a worker forked from a parent that used Solr would otherwise share its keep-alive connections
+    backends.reconnect()
+    if cached:
+        cache.configure(path=cache_path)
+    if instrumented:
+        instrumentation.enable()
 
 
-def run_experiment(fn, test_decks, seed_count=1, root_directory='results', name=None):
+def run_experiment(fn, test_decks, seed_count=1, root_directory='results', name=None, batch_size=None, workers=None, shard_size=None, plots='aggregate', instrument=False, profile_rate=0.0, resume=True, rankings=False):
+    """
+    Run <fn> on every test deck with <seed_count> seeds and write the mean metrics (see metrics.METRICS) per key to summary.txt.
+    <fn>(deck, seed) returns a dict of key -> (recommendations, relevant cards),
+    with a <batch_size> it is a batched experiment (see final_results_batch) that returns a list of those dicts.
+    Test cases are evaluated in shards of <shard_size> (default <batch_size>, or 16) test cases, batches don't span shards.
+    With <workers>, shards are evaluated in a process pool, <fn> has to be picklable.
+    Every evaluated test case is stored in the result store <root_directory>/results.sqlite (see results_store.py) as soon as its shard is done,
+    with <rankings> including the ranked lists. With <resume>, test cases of the experiment already in the store with all
+    keys of <fn> are skipped, so an interrupted run continues where it stopped and a run with more test decks, seeds or
+    grid points (see create_tune_experiment) only evaluates the new test cases and those lacking a key;
+    without it the experiment's stored results are discarded first. Change the <name> when <fn> changes.
+    The summary is aggregated from the store over all requested test cases, so it is identical to a serial run.
+    Precision-recall data is stored in plots.PR_VALUES_FILE and plotted after all test cases are evaluated,
+    <plots> is 'none', 'aggregate' or 'all', see plots.render_plots.
+    With <instrument>, the time spent per stage (see instrumentation.py) is written to TIMINGS_FILE,
+    and with a <profile_rate> that sample of the test cases is run under cProfile, summarized in PROFILE_FILE.
+    """
     if name is None:
         name = fn.__name__
 
@@ -23,63 +135,65 @@ def run_experiment(fn, test_decks, seed_count=1, root_directory='results', name=
     if not parent_folder.is_dir():
         parent_folder.mkdir(parents=True)
 
-    
-    acc1 = Counter() # hold accumulated average precision 
-    acc2 = Counter() # hold accumulated R-precision
-
-    # go over random decks and random seeds = random test cases
-    for deck_id in tqdm(test_decks):
-        deck = utils.import_deck(constants.TEST_DECKS / f'{deck_id}.json')
-        
-        for seed in range(seed_count):
-            # create folder for test case
-            if seed_count > 1:
-                folder = parent_folder / f'{deck_id}/seed={seed}'
+    was_enabled = instrumentation.ENABLED
+    if instrument:
+        instrumentation.reset()
+        instrumentation.enable()
+    try:
+        start = time.perf_counter()
+        profiles = parent_folder / PROFILES
+        if profile_rate > 0:
+            for file in profiles.glob('*.prof'):
+                file.unlink()
+
+        store = results_store.ResultStore(pathlib.Path(root_directory) / results_store.STORE_FILE)
+        if not resume:
+            store.clear(name)
+
+        # go over random decks and random seeds = random test cases, skipping those already stored
+        cases = [(deck_id, seed) for deck_id in test_decks for seed in range(seed_count)]
+        completed = store.completed(name, getattr(fn, 'keys', None))
+        remaining = [case for case in cases if case not in completed]
+        if shard_size is None:
+            shard_size = batch_size if batch_size is not None else 16
+        shards = [remaining[i:i + shard_size] for i in range(0, len(remaining), shard_size)]
+
+        with tqdm(total=len(cases), initial=len(cases) - len(remaining)) as progress:
+            def store_shards(shard_metrics):
+                for shard_results, shard_timings in shard_metrics:
+                    instrumentation.merge(shard_timings)
+                    with instrumentation.timer('experiment.store'):
+                        store.add(name, shard_results)
+                    progress.update(len(shard_results))
+
+            if workers is None:
+                store_shards(_run_shard(fn, shard, batch_size, parent_folder, profile_rate, rankings) for shard in shards)
             else:
-                folder = parent_folder / f'{deck_id}'
-            
-            if not folder.is_dir():
-                folder.mkdir(parents=True)
-
-            # perform experiment on test case
-            results = fn(deck, seed)
-
-            res = dict()
-            for key, value in results.items():
-                recommendations, relevant_cards = value
-
-                # calculate precision and recall for different k
-                P, R = recommender.pr_values(recommendations, relevant_cards)
-
-                # calculate metrics
-                m1 = recommender.average_precision(recommendations, relevant_cards)
-                m2 = recommender.r_precision(recommendations, relevant_cards)
-                acc1[key] += m1
-                acc2[key] += m2
-
-                res[key] = m1, m2
-
-                # plot precision and recall values
-                recommender.pr_curve(P, R)
-                plt.savefig(folder / f'{key}.png')
-                plt.close()
-
-            with open(folder / 'summary.txt', 'w') as f:
-                for k, v in res.items():
-                    v1, v2 = v
-                    v1f = "{:5.4f}".format(v1 / seed_count)
-                    v2f = "{:5.4f}".format(v2 / seed_count)
-                    f.write(f'{k}\t{v1f}\t{v2f}\n')
-    
-
-    # write average precision in summary file
-    with open(parent_folder / 'summary.txt', 'w') as f:
-        for k, v1 in acc1.items():
-            v2 = acc2[k]
-
-            v1f = "{:5.4f}".format(v1 / (len(test_decks) * seed_count))
-            v2f = "{:5.4f}".format(v2 / (len(test_decks) * seed_count))
-            f.write(f'{k}\t{v1f}\t{v2f}\n')
+                results_cache = cache.get_cache()
+                cache_args = (results_cache is not None, results_cache.path if results_cache is not None else None)
+                with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(BACKEND, *cache_args, instrumentation.ENABLED)) as executor:
+                    store_shards(executor.map(_run_shard, *zip(*[(fn, shard, batch_size, parent_folder, profile_rate, rankings) for shard in shards])))
+
+        # write mean metrics in summary file: average precision, R-precision, nDCG, reciprocal rank
+        with instrumentation.timer('experiment.write_summary'), open(parent_folder / 'summary.txt', 'w') as f:
+            for k, v in store.summary(name, cases).items():
+                formatted = "\t".join("{:5.4f}".format(m) for m in v)
+                f.write(f'{k}\t{formatted}\n')
+
+        with instrumentation.timer('experiment.save_pr_values'):
+            store.pr_values(name, cases, seed_count).save(parent_folder / plots_module.PR_VALUES_FILE)
+        with instrumentation.timer('experiment.plots'):
+            plots_module.render_plots(parent_folder, plots, workers)
+
+        if instrument:
+            instrumentation.record('experiment.total', time.perf_counter() - start)
+            instrumentation.write_report(parent_folder / TIMINGS_FILE)
+        if profile_rate > 0:
+            instrumentation.write_profile_report(sorted(profiles.glob('*.prof')), parent_folder / PROFILE_FILE)
+    finally:
+        # a failed run must not leave instrumentation enabled for the rest of the process
+        if instrument and not was_enabled:
+            instrumentation.disable()
 
 def varying_left_out(deck, seed):
     """
@@ -89,11 +203,12 @@ def varying_left_out(deck, seed):
     results = dict()
     for leave_out_count in range(5, 51, 5):
         query, relevant_cards  = recommender.deck_to_testcase(deck, leave_out_count, seed)
-        recommendations = recommender.generate_recommendations(" ".join(query), k=1000, 
+        recommendations = recommender.generate_recommendations(" ".join(sorted(query)), k=1000, 
             similar_decks_count=10,
             use_deck_score=False,
             discount_factor=1.0,
-            calculate_df_factor='no'
+            calculate_df_factor='no',
+            backend=BACKEND
         )
         results[leave_out_count] = recommendations, relevant_cards
 
@@ -103,19 +218,21 @@ def final_results(deck, seed):
     results = dict()
     for leave_out_count in [5, 25, 50]:
         query, relevant_cards  = recommender.deck_to_testcase(deck, leave_out_count, seed)
-        recommendations = recommender.generate_recommendations(" ".join(query), 
+        recommendations = recommender.generate_recommendations(" ".join(sorted(query)), 
             similar_decks_count=5,
             use_deck_score=True,
             discount_factor=0.7,
-            calculate_df_factor='df'
+            calculate_df_factor='df',
+            backend=BACKEND
         )
         results[f'{leave_out_count} tuned'] = recommendations, relevant_cards
 
-        recommendations = recommender.generate_recommendations(" ".join(query), 
+        recommendations = recommender.generate_recommendations(" ".join(sorted(query)), 
             similar_decks_count=25,
             use_deck_score=False,
             discount_factor=1.0,
-            calculate_df_factor='no'
+            calculate_df_factor='no',
+            backend=BACKEND
         )
         results[f'{leave_out_count} untuned'] = recommendations, relevant_cards
 
@@ -123,60 +240,170 @@ def final_results(deck, seed):
     return results
 
 
-def create_tune_experiment(parameter_grid):
-    def fn(deck, seed):
-        results = dict()
-        query, relevant_cards = recommender.deck_to_testcase(deck, 25, seed)
-        for parameters in parameter_grid:
-            recommendations = recommender.generate_recommendations(" ".join(query), k=1000, **parameters)
+FINAL_CONFIGURATIONS = {
+    'tuned': dict(similar_decks_count=5, use_deck_score=True, discount_factor=0.7, calculate_df_factor='df'),
+    'untuned': dict(similar_decks_count=25, use_deck_score=False, discount_factor=1.0, calculate_df_factor='no'),
+}
+
+
+def final_results_batch(decks, seeds):
+    """
+    Batched version of final_results: every configuration is one generate_recommendations_batch call over all decks.
+    """
+    results = [dict() for _ in decks]
+    for leave_out_count in [5, 25, 50]:
+        testcases = [recommender.deck_to_testcase(deck, leave_out_count, seed) for deck, seed in zip(decks, seeds)]
+        queries = [" ".join(sorted(query)) for query, _ in testcases]
+        for label, parameters in FINAL_CONFIGURATIONS.items():
+            batch = recommender.generate_recommendations_batch(queries, backend=BACKEND, **parameters)
+            for result, recommendations, (_, relevant_cards) in zip(results, batch, testcases):
+                result[f'{leave_out_count} {label}'] = recommendations, relevant_cards
+
+    return results
+
+
+ENGINE_SECONDS = dict() # seconds every engine of engines_batch spent generating recommendations
+
+
+def engines_batch(decks, seeds):
+    """
+    Batched experiment comparing the MLT recommendations (tuned configuration) with item-based recommendations
+    of the co-occurrence index (see cooccurrence.py) for every weighting, on the same queries.
+    The time every engine takes is added to ENGINE_SECONDS, with the result cache disabled.
+    """
+    results = [dict() for _ in decks]
+    testcases = [recommender.deck_to_testcase(deck, 25, seed) for deck, seed in zip(decks, seeds)]
+    queries = [" ".join(sorted(query)) for query, _ in testcases]
+
+    index = cooccurrence.open_index()
+    engines = {'mlt': functools.partial(recommender.generate_recommendations_batch, queries, k=1000, backend=BACKEND, **FINAL_CONFIGURATIONS['tuned'])}
+    for weighting in cooccurrence.WEIGHTINGS:
+        engines[f'cooccurrence {weighting}'] = functools.partial(index.recommend_batch, queries, 1000, weighting)
+
+    with cache.disabled():
+        for engine, generate in engines.items():
+            start = time.perf_counter()
+            batch = generate()
+            ENGINE_SECONDS[engine] = ENGINE_SECONDS.get(engine, 0.0) + time.perf_counter() - start
+            for result, recommendations, (_, relevant_cards) in zip(results, batch, testcases):
+                result[engine] = recommendations, relevant_cards
+    return results
+
+
+def compare_engines(test_decks, seed_count=1, root_directory='results', name='engines', batch_size=64):
+    """
+    Evaluate engines_batch and write the latency of every engine to latency.txt next to summary.txt:
+    engine, total seconds and milliseconds per query. Runs serially, so the timings are comparable.
+    """
+    ENGINE_SECONDS.clear()
+    # every test case is run again, the timings need all of them
+    run_experiment(engines_batch, test_decks, seed_count, root_directory, name, batch_size=batch_size, resume=False)
+
+    queries = len(test_decks) * seed_count
+    with open(pathlib.Path(f'{root_directory}/{name}') / 'latency.txt', 'w') as f:
+        for engine, seconds in ENGINE_SECONDS.items():
+            f.write(f'{engine}\t{seconds:.3f}\t{1000 * seconds / queries:.3f}\n')
+
+
+def tune_experiment(deck, seed, parameter_grid, sweep=False):
+    """
+    Evaluate every point of <parameter_grid> on the same test case, see create_tune_experiment.
+    """
+    results = dict()
+    query, relevant_cards = recommender.deck_to_testcase(deck, 25, seed)
+    if sweep:
+        sweep_results = recommender.generate_recommendations_sweep([" ".join(sorted(query))], parameter_grid, k=1000, backend=BACKEND)[0]
+        for parameters, recommendations in zip(parameter_grid, sweep_results):
             results[tuple(parameters.values())] = recommendations, relevant_cards
         return results
 
-    return fn
+    for parameters in parameter_grid:
+        recommendations = recommender.generate_recommendations(" ".join(sorted(query)), k=1000, backend=BACKEND, **parameters)
+        results[tuple(parameters.values())] = recommendations, relevant_cards
+    return results
+
+
+def tune_experiment_batch(decks, seeds, parameter_grid, sweep=False):
+    """
+    Batched version of tune_experiment.
+    """
+    results = [dict() for _ in decks]
+    testcases = [recommender.deck_to_testcase(deck, 25, seed) for deck, seed in zip(decks, seeds)]
+    queries = [" ".join(sorted(query)) for query, _ in testcases]
+    if sweep:
+        sweep_results = recommender.generate_recommendations_sweep(queries, parameter_grid, k=1000, backend=BACKEND)
+        for result, deck_results, (_, relevant_cards) in zip(results, sweep_results, testcases):
+            for parameters, recommendations in zip(parameter_grid, deck_results):
+                result[tuple(parameters.values())] = recommendations, relevant_cards
+        return results
+
+    for parameters in parameter_grid:
+        batch = recommender.generate_recommendations_batch(queries, k=1000, backend=BACKEND, **parameters)
+        for result, recommendations, (_, relevant_cards) in zip(results, batch, testcases):
+            result[tuple(parameters.values())] = recommendations, relevant_cards
+    return results
+
+
+def create_tune_experiment(parameter_grid, batched=False, sweep=False):
+    """
+    Create an experiment evaluating every point of <parameter_grid> on the same test case, keyed by the parameter values.
+    With <batched>, the experiment is a batched experiment for run_experiment(..., batch_size=...).
+    With <sweep>, similar decks are retrieved once per test case and every grid point is rescored from them,
+    see recommender.generate_recommendations_sweep.
+    The experiment is a partial of a module level function, so it can be sent to worker processes.
+    """
+    fn = tune_experiment_batch if batched else tune_experiment
+    experiment = functools.update_wrapper(functools.partial(fn, parameter_grid=parameter_grid, sweep=sweep), fn)
+    # the keys the experiment returns, so run_experiment can resume a run of a grid that gained points
+    experiment.keys = [tuple(parameters.values()) for parameters in parameter_grid]
+    return experiment
 
 
 if __name__ == '__main__':
+    # reruns reuse the recommendations of earlier runs, see cache.py
+    cache.configure(path=constants.RESULTS_CACHE)
+
     similar_decks_count = create_tune_experiment(utils.ParameterGrid({
         'similar_decks_count': list(range(1, 26)),
         'use_deck_score': [False],
         'discount_factor': [1],
         'calculate_df_factor': ['no']
-    }))
+    }), sweep=True)
 
     similar_decks_count2 = create_tune_experiment(utils.ParameterGrid({
         'similar_decks_count': list(range(25, 501, 25)),
         'use_deck_score': [False],
         'discount_factor': [1],
         'calculate_df_factor': ['no']
-    }))
+    }), sweep=True)
 
     use_deck_score = create_tune_experiment(utils.ParameterGrid({
         'similar_decks_count': [1000],
         'use_deck_score': [False, True],
         'discount_factor': [1],
         'calculate_df_factor': ['no']
-    }))
+    }), sweep=True)
 
     discount_factor = create_tune_experiment(utils.ParameterGrid({
         'similar_decks_count': [1000],
         'use_deck_score': [False,],
         'discount_factor': [1, 0.9, 0.8, 0.7, 0.6, 0.5, 0.4, 0.3, 0.2, 0.1],
         'calculate_df_factor': ['no']
-    }))
+    }), sweep=True)
 
     combining_three = create_tune_experiment(utils.ParameterGrid({
         'similar_decks_count': [3, 4, 5, 6, 10, 1000],
         'discount_factor': [1, 0.9, 0.8, 0.7, 0.6, 0.5],
         'use_deck_score': [False, True],
         'calculate_df_factor': ['no']
-    }))
+    }), sweep=True)
 
     calculate_df_factor = create_tune_experiment(utils.ParameterGrid({
         'similar_decks_count': [5],
         'discount_factor': [0.7],
         'use_deck_score': [True],
         'calculate_df_factor': ['no', 'idf', 'prob-idf', 'df']
-    }))
+    }), sweep=True)
 
     random.seed(0)
     tune_decks = set(random.sample(TEST_DECKS_IDS, 500))
@@ -189,6 +416,14 @@ if __name__ == '__main__':
     # run_experiment(calculate_df_factor, tune_decks, name="calculate_df_factor")
 
     test_decks = set(random.sample(TEST_DECKS_IDS, 5156)) - tune_decks # because 156 decks overlap
-    run_experiment(final_results, test_decks)
+
+    if BACKEND == 'matrix':
+        # matrix results stand in for Solr's only while both return the same similar decks
+        try:
+            backends.assert_parity(sorted(test_decks)[:200])
+        except OSError:
+            print('Solr is not reachable, parity of the matrix backend is not checked')
+    run_experiment(final_results_batch, test_decks, batch_size=64, shard_size=512, name='final_results')
+    # compare_engines(test_decks)
 
     
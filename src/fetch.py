@@ -0,0 +1,91 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import requests
+
+# responses worth retrying: rate limited or a server side error
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """
+    Thread-safe rate limiter: acquire() blocks until a request may be sent, at most <rate> per second
+    with bursts of <capacity> requests.
+    """
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            # take the token now and sleep outside the lock until it is paid back
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay > 0:
+            time.sleep(delay)
+
+
+def make_session(workers=16):
+    """
+    Session with a connection pool large enough for <workers> threads.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get(session, url, bucket=None, retries=5, backoff=1.0, timeout=30, **kwargs):
+    """
+    GET <url>, retrying 429 and 5xx responses and connection errors with exponential backoff.
+    A Retry-After header of the server is respected. Return the last response, raise the last
+    connection error if every attempt failed.
+    """
+    for attempt in range(retries + 1):
+        if bucket is not None:
+            bucket.acquire()
+        try:
+            r = session.get(url, timeout=timeout, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == retries:
+                raise
+            r = None
+
+        if r is not None and (r.status_code not in RETRY_STATUS or attempt == retries):
+            return r
+
+        delay = backoff * 2**attempt * random.uniform(0.5, 1)
+        retry_after = r.headers.get('Retry-After') if r is not None else None
+        if retry_after is not None and retry_after.isdigit():
+            delay = max(delay, int(retry_after))
+        time.sleep(delay)
+
+
+def window(fn, items, workers=16):
+    """
+    Call <fn> on every item with at most <workers> calls in flight, a slow call does not hold back the others.
+    Yield (item, result) in completion order.
+    """
+    items = iter(items)
+    end = object()
+    with ThreadPoolExecutor(workers) as executor:
+        pending = dict()
+        for item in items:
+            pending[executor.submit(fn, item)] = item
+            if len(pending) == workers:
+                break
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
+                item = next(items, end)
+                if item is not end:
+                    pending[executor.submit(fn, item)] = item
@@ -0,0 +1,115 @@
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import requests
+
+import constants
+import corpus
+
+
+def add_decks(decks, commit_within=10000, session=None, url=None):
+    """
+    Add (or replace) processed decks, dicts with 'id' and 'cards', in the Solr 'decks' core.
+    """
+    session = session or requests
+    url = url or constants.SOLR_URL
+    r = session.post(f'{url}/update', params={'commitWithin': commit_within}, json=list(decks))
+    r.raise_for_status()
+
+
+def delete_decks(deck_ids, commit_within=10000, session=None, url=None):
+    """
+    Delete decks by id from the Solr 'decks' core.
+    """
+    session = session or requests
+    url = url or constants.SOLR_URL
+    r = session.post(f'{url}/update', params={'commitWithin': commit_within}, json={'delete': list(deck_ids)})
+    r.raise_for_status()
+
+
+def commit(session=None, url=None):
+    session = session or requests
+    url = url or constants.SOLR_URL
+    r = session.post(f'{url}/update', params={'commit': 'true'}, json={})
+    r.raise_for_status()
+
+
+def iter_documents(directory):
+    """
+    Yield the Solr documents of the processed decks in <directory>, from its packed corpus if there is one.
+    """
+    packed = corpus.open_corpus(directory)
+    if packed is not None:
+        for deck_id in packed.ids:
+            yield {'id': deck_id, 'cards': ' '.join(packed.deck(deck_id))}
+    else:
+        for deck_id, cards in corpus.iter_decks(directory):
+            yield {'id': deck_id, 'cards': ' '.join(cards)}
+
+
+def batches(documents, batch_size):
+    batch = list()
+    for document in documents:
+        batch.append(document)
+        if len(batch) == batch_size:
+            yield batch
+            batch = list()
+    if batch:
+        yield batch
+
+
+def send(documents, batch_size=1000, workers=4, commit_within=10000, url=None, session=None):
+    """
+    Add <documents> as json arrays of <batch_size> documents, sent by <workers> threads sharing a pooled session.
+    Return the number of documents sent.
+    """
+    if session is None:
+        session = requests.Session()
+        session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=workers))
+
+    count = 0
+    with ThreadPoolExecutor(workers) as executor:
+        pending = set()
+        for batch in batches(documents, batch_size):
+            # bound the number of batches in memory
+            if len(pending) >= 2 * workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    count += future.result()
+            pending.add(executor.submit(_send, batch, commit_within, session, url))
+        for future in pending:
+            count += future.result()
+    return count
+
+
+def index(directory=None, batch_size=1000, workers=4, commit_within=10000, url=None, verbose=True):
+    """
+    Index the processed decks in <directory> (default constants.STORED_DECKS), replaces `./bin/post -c decks <directory>`.
+    Decks are sent as json arrays of <batch_size> documents by <workers> threads sharing a pooled session (see send),
+    Solr commits every <commit_within> ms and once at the end. <url> defaults to constants.SOLR_URL.
+    Return the number of indexed decks and the throughput in docs/s.
+    """
+    directory = directory if directory is not None else constants.STORED_DECKS
+    session = requests.Session()
+    session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=workers))
+
+    start = time.perf_counter()
+    count = send(iter_documents(directory), batch_size, workers, commit_within, url, session)
+    commit(session, url)
+
+    seconds = time.perf_counter() - start
+    throughput = count / seconds if seconds > 0 else 0.0
+    if verbose:
+        print(f'indexed {count} decks in {seconds:.1f}s ({throughput:.0f} docs/s)')
+    return count, throughput
+
+
+def _send(batch, commit_within, session, url):
+    add_decks(batch, commit_within, session, url)
+    return len(batch)
+
+
+if __name__ == '__main__':
+    import pathlib
+
+    index(pathlib.Path(sys.argv[1]) if len(sys.argv) > 1 else None)
@@ -0,0 +1,231 @@
+import cProfile
+import hashlib
+import math
+import pstats
+import threading
+import time
+
+# instrumentation is off unless enabled, timers and counters then cost one function call and a global lookup
+ENABLED = False
+
+_lock = threading.Lock()
+_timers = dict() # stage -> Histogram of seconds
+_histograms = dict() # name -> Histogram of values
+_counters = dict() # name -> count
+
+
+class Histogram:
+    """
+    Count, total, min and max of the recorded values and a log2 bucketed histogram for approximate percentiles.
+    """
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.buckets = dict() # exponent e -> number of values in [2 ** (e - 1), 2 ** e)
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        bucket = math.frexp(value)[1]
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+
+    def percentile(self, q):
+        """
+        Upper bound of the bucket holding the <q>-th percentile, clamped to the recorded range.
+        """
+        if self.count == 0:
+            return 0.0
+        rank = q / 100 * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(max(2.0 ** bucket, self.min), self.max)
+        return self.max
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+
+class _Timer:
+    __slots__ = ('stage', 'start')
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.stage, time.perf_counter() - self.start)
+
+
+class _NoTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NO_TIMER = _NoTimer()
+
+
+def timer(stage):
+    """
+    Context manager adding the seconds its block takes to the timer of <stage>.
+    """
+    if not ENABLED:
+        return _NO_TIMER
+    return _Timer(stage)
+
+
+def _add(table, name, value):
+    with _lock:
+        histogram = table.get(name)
+        if histogram is None:
+            histogram = table[name] = Histogram()
+        histogram.add(value)
+
+
+def record(stage, seconds):
+    """
+    Add <seconds> to the timer of <stage>, for stages that are timed by the caller.
+    """
+    if ENABLED:
+        _add(_timers, stage, seconds)
+
+
+def observe(name, value):
+    """
+    Add <value> to the histogram <name>, e.g. the number of decks a request returned.
+    """
+    if ENABLED:
+        _add(_histograms, name, value)
+
+
+def count(name, n=1):
+    if ENABLED:
+        with _lock:
+            _counters[name] = _counters.get(name, 0) + n
+
+
+def enable():
+    global ENABLED
+    ENABLED = True
+
+
+def disable():
+    global ENABLED
+    ENABLED = False
+
+
+def reset():
+    with _lock:
+        _timers.clear()
+        _histograms.clear()
+        _counters.clear()
+
+
+def collect():
+    """
+    Return the recorded timers, histograms and counters and reset them, e.g. to send them from a worker process
+    to the parent, which adds them with merge. Return None when instrumentation is disabled.
+    """
+    if not ENABLED:
+        return None
+    with _lock:
+        snapshot = {'timers': dict(_timers), 'histograms': dict(_histograms), 'counters': dict(_counters)}
+    reset()
+    return snapshot
+
+
+def merge(snapshot):
+    if snapshot is None:
+        return
+    with _lock:
+        for table, name in ((_timers, 'timers'), (_histograms, 'histograms')):
+            for key, histogram in snapshot[name].items():
+                table.setdefault(key, Histogram()).merge(histogram)
+        for key, n in snapshot['counters'].items():
+            _counters[key] = _counters.get(key, 0) + n
+
+
+def write_report(file):
+    """
+    Write the timers (in milliseconds), histograms and counters as tab separated tables, stages in order of total time.
+    """
+    with _lock:
+        timers = sorted(_timers.items(), key=lambda item: -item[1].total)
+        histograms = sorted(_histograms.items())
+        counters = sorted(_counters.items())
+
+    with open(file, 'w') as f:
+        f.write('stage\tcount\ttotal_s\tmean_ms\tp50_ms\tp90_ms\tp99_ms\tmax_ms\n')
+        for stage, h in timers:
+            f.write(f'{stage}\t{h.count}\t{h.total:.3f}\t{h.mean * 1000:.3f}\t{h.percentile(50) * 1000:.3f}\t{h.percentile(90) * 1000:.3f}\t{h.percentile(99) * 1000:.3f}\t{h.max * 1000:.3f}\n')
+        if histograms:
+            f.write('\nhistogram\tcount\tmean\tmin\tp50\tp90\tmax\n')
+            for name, h in histograms:
+                f.write(f'{name}\t{h.count}\t{h.mean:.2f}\t{h.min:g}\t{h.percentile(50):g}\t{h.percentile(90):g}\t{h.max:g}\n')
+        if counters:
+            f.write('\ncounter\tcount\n')
+            for name, n in counters:
+                f.write(f'{name}\t{n}\n')
+
+
+def sampled(key, rate):
+    """
+    Deterministic sample of <rate> of all keys, a key is always in or out of the sample.
+    """
+    if rate <= 0:
+        return False
+    return int(hashlib.md5(key.encode()).hexdigest()[:8], 16) / 2**32 < rate
+
+
+class Profile:
+    """
+    Context manager profiling its block with cProfile and writing the statistics to <file>, or doing nothing without a <file>.
+    """
+    def __init__(self, file=None):
+        self.file = file
+        self.profiler = None
+
+    def __enter__(self):
+        if self.file is not None:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        return self
+
+    def __exit__(self, *exc):
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.file.parent.mkdir(parents=True, exist_ok=True)
+            self.profiler.dump_stats(self.file)
+
+
+def write_profile_report(files, file, limit=40):
+    """
+    Combine the cProfile statistics <files> and write the <limit> functions with the most cumulative time to <file>.
+    """
+    files = [str(f) for f in files]
+    if not files:
+        return
+    with open(file, 'w') as f:
+        stats = pstats.Stats(*files, stream=f)
+        f.write(f'{len(files)} profiled test cases\n')
+        stats.sort_stats('cumulative').print_stats(limit)
@@ -0,0 +1,131 @@
+import numpy as np
+
+# hashes are (a * x + b) mod a Mersenne prime, computed in uint64 and stored as uint32
+PRIME = np.uint64(2**31 - 1)
+
+
+class MinHash:
+    """
+    MinHash signatures of decks as sets of card ids: <num_perm> random hash functions,
+    the signature holds the minimum hash of the deck's cards for every function.
+    Two decks agree on a signature value with probability equal to their Jaccard similarity.
+    """
+    def __init__(self, n_cards, num_perm=128, seed=1):
+        rng = np.random.default_rng(seed)
+        a = rng.integers(1, int(PRIME), num_perm, dtype=np.uint64)
+        b = rng.integers(0, int(PRIME), num_perm, dtype=np.uint64)
+        cards = np.arange(n_cards, dtype=np.uint64)
+        # hash of every card for every function, a signature is then a minimum over table columns
+        self.table = ((a[:, None] * cards[None, :] + b[:, None]) % PRIME).astype(np.uint32)
+        self.num_perm = num_perm
+
+    def signature(self, card_ids):
+        if len(card_ids) == 0:
+            return np.full(self.num_perm, np.iinfo(np.uint32).max, dtype=np.uint32)
+        return self.table[:, card_ids].min(axis=1)
+
+    def signatures(self, indptr, indices, start, end):
+        """
+        Signatures of the decks <start> to <end> of a CSR deck x card matrix, as a (decks x num_perm) array.
+        """
+        offsets = indptr[start:end + 1] - indptr[start]
+        hashes = self.table[:, indices[indptr[start]:indptr[end]]]
+        signatures = np.full((end - start, self.num_perm), np.iinfo(np.uint32).max, dtype=np.uint32)
+        nonempty = np.flatnonzero(np.diff(offsets) > 0)
+        if len(nonempty):
+            signatures[nonempty] = np.minimum.reduceat(hashes, offsets[nonempty], axis=1).T
+        return signatures
+
+
+class LSHIndex:
+    """
+    Banded LSH over MinHash signatures: the signature is cut in <bands> bands and decks that agree on every value
+    of a band share a bucket. More bands (of fewer rows) find more candidates: better recall, slower queries.
+    Buckets are stored per band as sorted band keys with the decks in key order.
+    """
+    def __init__(self, keys, order, bands):
+        self.keys = keys
+        self.order = order
+        self.bands = bands
+
+    @staticmethod
+    def band_keys(signatures, bands, seed=1):
+        """
+        One uint64 key per band of every signature, a random linear combination of the band's values.
+        """
+        rows = signatures.shape[1] // bands
+        multipliers = np.random.default_rng(seed).integers(1, 2**63, rows, dtype=np.uint64) | np.uint64(1)
+        values = signatures[:, :bands * rows].astype(np.uint64).reshape(len(signatures), bands, rows)
+        # uint64 arithmetic wraps around, which is fine for a hash
+        return (values * multipliers).sum(axis=2, dtype=np.uint64)
+
+    @staticmethod
+    def build(minhash, indptr, indices, bands, chunk_size=1024):
+        n_decks = len(indptr) - 1
+        keys = np.zeros((bands, n_decks), dtype=np.uint64)
+        for start in range(0, n_decks, chunk_size):
+            end = min(start + chunk_size, n_decks)
+            keys[:, start:end] = LSHIndex.band_keys(minhash.signatures(indptr, indices, start, end), bands).T
+        order = np.argsort(keys, axis=1, kind='stable')
+        return LSHIndex(np.take_along_axis(keys, order, axis=1), order.astype(np.int64), bands)
+
+    def candidates(self, signature, max_candidates=None):
+        """
+        Decks that share at least one bucket with <signature>, the <max_candidates> decks sharing the most buckets
+        when there are more.
+        """
+        query = LSHIndex.band_keys(signature[None, :], self.bands)[0]
+        decks = list()
+        for band in range(self.bands):
+            lo = np.searchsorted(self.keys[band], query[band], 'left')
+            hi = np.searchsorted(self.keys[band], query[band], 'right')
+            decks.append(self.order[band, lo:hi])
+        decks, counts = np.unique(np.concatenate(decks), return_counts=True)
+        if max_candidates is not None and len(decks) > max_candidates:
+            decks = np.sort(decks[np.argsort(-counts, kind='stable')[:max_candidates]])
+        return decks
+
+
+def benchmark(deck_ids=None, rows=(10, 100, 1000), leave_out_count=25, seed=0, **parameters):
+    """
+    Recall@N of the similar decks of the lsh backend (built with <parameters>, see backends.LSHBackend)
+    against exact retrieval by the matrix backend, on test cases of the test decks, and the mean query time of both.
+    """
+    import time
+    import backends
+    import constants
+    import recommender
+    import utils
+
+    exact = backends.get_backend('matrix')
+    approximate = backends.LSHBackend(**parameters)
+
+    if deck_ids is None:
+        deck_ids = sorted(file.stem for file in constants.TEST_DECKS.glob('*.json'))[:200]
+    queries = list()
+    for deck_id in deck_ids:
+        deck = utils.import_deck(constants.TEST_DECKS / f'{deck_id}.json')
+        query, _ = recommender.deck_to_testcase(deck, leave_out_count, seed)
+        queries.append(" ".join(sorted(query)))
+
+    results = {'exact_seconds': 0.0, 'approximate_seconds': 0.0}
+    for n in rows:
+        start = time.perf_counter()
+        expected = exact.similar_decks_batch(queries, n)
+        results['exact_seconds'] += time.perf_counter() - start
+        start = time.perf_counter()
+        actual = approximate.similar_decks_batch(queries, n)
+        results['approximate_seconds'] += time.perf_counter() - start
+
+        recall = [len(set(e.ids) & set(a.ids)) / len(e.ids) for e, a in zip(expected, actual) if len(e.ids)]
+        results[f'recall@{n}'] = float(np.mean(recall)) if recall else 0.0
+
+    # mean time per query and rows setting
+    results['exact_seconds'] /= len(queries) * len(rows)
+    results['approximate_seconds'] /= len(queries) * len(rows)
+    return results
+
+
+if __name__ == '__main__':
+    for num_perm, bands in ((128, 32), (128, 64), (64, 64), (128, 128)):
+        print(f'num_perm={num_perm} bands={bands}', benchmark(num_perm=num_perm, bands=bands))
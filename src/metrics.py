@@ -0,0 +1,107 @@
+import numpy as np
+
+# metrics reported per ranked list, in summary column order
+METRICS = ('average_precision', 'r_precision', 'ndcg', 'reciprocal_rank')
+
+
+def relevance(recommendations, relevant_cards):
+    """
+    Boolean vector marking which recommendations are relevant cards.
+    """
+    return np.fromiter((r in relevant_cards for r in recommendations), dtype=bool, count=len(recommendations))
+
+
+def relevance_matrix(batch):
+    """
+    Stack the relevance vectors of a batch of (recommendations, relevant cards) into a matrix padded with False.
+    Return the matrix and the number of relevant cards of every row.
+    """
+    width = max((len(recommendations) for recommendations, _ in batch), default=0)
+    matrix = np.zeros((len(batch), width), dtype=bool)
+    for row, (recommendations, relevant_cards) in enumerate(batch):
+        matrix[row, :len(recommendations)] = relevance(recommendations, relevant_cards)
+    n_relevant = np.array([len(relevant_cards) for _, relevant_cards in batch], dtype=np.float64)
+
+    return matrix, n_relevant
+
+
+def precision_recall(rel, n_relevant):
+    """
+    precision@k and recall@k for k from 1 to the length of the ranked list(s), <rel> is a relevance vector or matrix.
+    """
+    rel = np.asarray(rel)
+    hits = np.cumsum(rel, axis=-1)
+    ranks = np.arange(1, rel.shape[-1] + 1)
+
+    return hits / ranks, hits / np.asarray(n_relevant, dtype=np.float64)[..., None]
+
+
+def average_precision(rel):
+    """
+    Mean of precision@k over the ranks k of the relevant recommendations ~ area under precision-recall curve
+    """
+    rel = np.asarray(rel)
+    hits = np.cumsum(rel, axis=-1)
+    ranks = np.arange(1, rel.shape[-1] + 1)
+    total = hits[..., -1] if rel.shape[-1] else np.zeros(rel.shape[:-1])
+
+    result = np.sum(np.where(rel, hits / ranks, 0), axis=-1)
+    return np.divide(result, total, out=np.zeros_like(result, dtype=np.float64), where=total > 0)
+
+
+def r_precision(rel, n_relevant):
+    """
+    Precision at rank R, the number of relevant cards.
+    """
+    rel = np.asarray(rel)
+    n_relevant = np.asarray(n_relevant, dtype=np.float64)
+    within = np.arange(rel.shape[-1]) < n_relevant[..., None]
+
+    return np.sum(rel & within, axis=-1) / n_relevant
+
+
+def ndcg(rel, n_relevant):
+    """
+    Normalized discounted cumulative gain with binary gains over the full ranked list(s).
+    """
+    rel = np.asarray(rel)
+    n_relevant = np.asarray(n_relevant, dtype=np.int64)
+    discounts = 1 / np.log2(np.arange(2, max(rel.shape[-1], int(n_relevant.max(initial=0))) + 2))
+    ideal = np.concatenate(([0], np.cumsum(discounts)))[np.minimum(n_relevant, rel.shape[-1])]
+
+    dcg = np.sum(rel * discounts[:rel.shape[-1]], axis=-1)
+    return np.divide(dcg, ideal, out=np.zeros_like(dcg, dtype=np.float64), where=ideal > 0)
+
+
+def reciprocal_rank(rel):
+    """
+    1 / rank of the first relevant recommendation, 0 if there is none.
+    """
+    rel = np.asarray(rel)
+    if rel.shape[-1] == 0:
+        return np.zeros(rel.shape[:-1])
+    first = np.argmax(rel, axis=-1)
+
+    return np.where(np.any(rel, axis=-1), 1 / (first + 1), 0)
+
+
+def evaluate_batch(batch):
+    """
+    Calculate all METRICS for a batch of (recommendations, relevant cards).
+    Return a dict of metric -> array with a value per ranked list, and the relevance matrix.
+    """
+    rel, n_relevant = relevance_matrix(batch)
+    return {
+        'average_precision': average_precision(rel),
+        'r_precision': r_precision(rel, n_relevant),
+        'ndcg': ndcg(rel, n_relevant),
+        'reciprocal_rank': reciprocal_rank(rel),
+    }, rel
+
+
+def evaluate(recommendations, relevant_cards):
+    """
+    Calculate all METRICS for one ranked list of recommendations.
+    """
+    values, _ = evaluate_batch([(recommendations, relevant_cards)])
+    return {metric: float(values[metric][0]) for metric in METRICS}
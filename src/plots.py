@@ -0,0 +1,160 @@
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+import metrics
+import recommender
+
+PR_VALUES_FILE = 'pr_values.npz'
+
+# recall levels of the interpolated mean precision-recall curve
+RECALL_LEVELS = np.linspace(0, 1, 101)
+
+
+class PRValues:
+    """
+    Collects the precision-recall data of every (test case, key) of an experiment in a compact form:
+    the ranks of the relevant recommendations, the length of the ranked list and the number of relevant cards.
+    P and R can be recomputed from these at any time, see metrics.precision_recall.
+    """
+    def __init__(self):
+        self.folders = list()
+        self.keys = list()
+        self.lengths = list()
+        self.n_relevant = list()
+        self.hits = list()
+
+    def add(self, folder, key, rel, n_relevant):
+        self.folders.append(str(folder))
+        self.keys.append(str(key))
+        self.lengths.append(len(rel))
+        self.n_relevant.append(n_relevant)
+        self.hits.append(np.flatnonzero(rel).astype(np.int32))
+
+    def extend(self, other):
+        self.folders.extend(other.folders)
+        self.keys.extend(other.keys)
+        self.lengths.extend(other.lengths)
+        self.n_relevant.extend(other.n_relevant)
+        self.hits.extend(other.hits)
+
+    def subset(self, indices):
+        values = PRValues()
+        for index in indices:
+            values.folders.append(self.folders[index])
+            values.keys.append(self.keys[index])
+            values.lengths.append(self.lengths[index])
+            values.n_relevant.append(self.n_relevant[index])
+            values.hits.append(self.hits[index])
+        return values
+
+    def save(self, file):
+        hits_ptr = np.concatenate(([0], np.cumsum([len(h) for h in self.hits]))).astype(np.int64)
+        hits = np.concatenate(self.hits) if self.hits else np.zeros(0, dtype=np.int32)
+        np.savez_compressed(file,
+            folders=np.array(self.folders),
+            keys=np.array(self.keys),
+            lengths=np.array(self.lengths, dtype=np.int32),
+            n_relevant=np.array(self.n_relevant, dtype=np.int32),
+            hits_ptr=hits_ptr,
+            hits=hits
+        )
+
+    @staticmethod
+    def load(file):
+        data = np.load(file)
+        values = PRValues()
+        values.folders = data['folders'].tolist()
+        values.keys = data['keys'].tolist()
+        values.lengths = data['lengths'].tolist()
+        values.n_relevant = data['n_relevant'].tolist()
+        hits_ptr = data['hits_ptr']
+        values.hits = [data['hits'][hits_ptr[i]:hits_ptr[i + 1]] for i in range(len(values.keys))]
+        return values
+
+    def relevance(self, index):
+        rel = np.zeros(self.lengths[index], dtype=bool)
+        rel[self.hits[index]] = True
+        return rel
+
+    def pr_values(self, index):
+        return metrics.precision_recall(self.relevance(index), self.n_relevant[index])
+
+
+def interpolated_precision(P, R, recall_levels=RECALL_LEVELS):
+    """
+    Interpolated precision (highest precision at any recall >= level) at every recall level.
+    """
+    P = np.asarray(P)
+    R = np.asarray(R)
+    P_interpolated = np.concatenate((np.maximum.accumulate(P[::-1])[::-1], [0]))
+    return P_interpolated[np.searchsorted(R, recall_levels, side='left')]
+
+
+def mean_pr_curves(values):
+    """
+    Mean interpolated precision at RECALL_LEVELS for every key.
+    """
+    sums = dict()
+    counts = dict()
+    for index, key in enumerate(values.keys):
+        P, R = values.pr_values(index)
+        sums[key] = sums.get(key, 0) + interpolated_precision(P, R)
+        counts[key] = counts.get(key, 0) + 1
+
+    return {key: sums[key] / counts[key] for key in sums}
+
+
+def _plot_mean_curve(file, key, precision):
+    # imported here, so experiment processes that only store precision-recall data don't load matplotlib
+    import matplotlib.pyplot as plt
+
+    _, ax = plt.subplots()
+    ax.plot(RECALL_LEVELS, precision)
+    ax.set_title(key)
+    ax.set_xlabel('Recall')
+    ax.set_ylabel('Interpolated precision')
+    ax.set_xlim([-0.01, 1.01])
+    ax.set_ylim([-0.01, 1.01])
+    plt.savefig(file)
+    plt.close()
+
+
+def _plot_test_cases(parent_folder, values):
+    import matplotlib.pyplot as plt
+
+    for index in range(len(values.keys)):
+        P, R = values.pr_values(index)
+        recommender.pr_curve(P, R)
+        folder = parent_folder / values.folders[index]
+        folder.mkdir(parents=True, exist_ok=True)
+        plt.savefig(folder / f'{values.keys[index]}.png')
+        plt.close()
+
+
+def render_plots(parent_folder, plots='aggregate', workers=None, chunk_size=256):
+    """
+    Render the plots of an experiment from its stored precision-recall data:
+        + 'none': nothing
+        + 'aggregate': one interpolated mean precision-recall curve per key, mean_pr_<key>.png
+        + 'all': the aggregate curves and a precision-recall curve per key in every test case folder
+    Plots are rendered in a process pool of <workers> processes.
+    """
+    if plots == 'none':
+        return
+    if plots not in ('aggregate', 'all'):
+        raise ValueError(f'Unknown plots option: {plots}')
+
+    values = PRValues.load(parent_folder / PR_VALUES_FILE)
+
+    with ProcessPoolExecutor(workers) as executor:
+        futures = list()
+        for key, precision in mean_pr_curves(values).items():
+            futures.append(executor.submit(_plot_mean_curve, parent_folder / f'mean_pr_{key}.png', key, precision))
+
+        if plots == 'all':
+            for start in range(0, len(values.keys), chunk_size):
+                chunk = values.subset(range(start, min(start + chunk_size, len(values.keys))))
+                futures.append(executor.submit(_plot_test_cases, parent_folder, chunk))
+
+        for future in futures:
+            future.result()
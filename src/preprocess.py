@@ -1,46 +1,272 @@
+import gzip
 import json
-import pathlib
-import random
-import re
+import hashlib
+from multiprocessing import Pool
 from tqdm import tqdm
 
 import utils
 import constants
+import corpus
+import indexer
+from backends import Terms
 
 TRAIN_TEST_SPLIT = 0.99
+# bump when the manifest entries change, see _migrate_manifest
+MANIFEST_VERSION = 2
 
 
 
-def main():
+def is_test_deck(deck_id):
+    """
+    Deterministic train/test split on a hash of the deck id, a deck always ends up in the same set.
+    """
+    h = int(hashlib.md5(deck_id.encode()).hexdigest()[:8], 16)
+    return h / 2**32 >= TRAIN_TEST_SPLIT
+
+
+def process_deck(data):
+    """
+    Preprocess a raw deck: only keep deck id and card list.
+    Return the processed json, or None for decks with less than 50 cards.
+    """
+    processed_json = {}
+    processed_json['id'] = data['urlhash']
+
+    processed_decklist = list()
+    decklist = data['cards']
+    for card in decklist:
+        processed_decklist.append(utils.sanitize(card))
+
+    processed_decklist.append(utils.sanitize(data['commanders'][0]))
+
+    if len(processed_decklist) < 50:
+        return None
+
+    processed_json['cards'] = ' '.join(processed_decklist)
+    return processed_json
+
+
+def raw_files():
+    """
+    Raw deck files in file name order: one json file per deck or gzip json lines shards of the downloader.
+    """
+    return sorted(list(constants.RAW_DECKS.glob('*.json')) + list(constants.RAW_DECKS.glob('*.jsonl.gz')))
+
+
+def process_file(file):
+    """
+    Return (stem, processed json) of every raw deck in <file>, decks in shards are named by their hash.
+    """
+    if file.name.endswith('.jsonl.gz'):
+        with gzip.open(file, 'rt') as f:
+            return [(data['urlhash'], process_deck(data)) for data in (json.loads(line) for line in f if line.strip())]
+    with open(file, 'r') as f:
+        data = json.load(f)
+    return [(file.stem, process_deck(data))]
+
+
+class ShardWriter:
+    """
+    Writes processed decks as json lines to shard-<n>.jsonl files of <shard_size> decks.
+    """
+    def __init__(self, directory, shard_size):
+        self.directory = directory
+        self.shard_size = shard_size
+        self.shard = 0
+        self.count = 0
+        self.file = None
+
+    def write(self, processed_json):
+        if self.file is None:
+            self.file = open(self.directory / f'shard-{self.shard:05d}.jsonl', 'w')
+        self.file.write(json.dumps(processed_json) + '\n')
+        self.count += 1
+        if self.count == self.shard_size:
+            self.close()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.shard += 1
+            self.count = 0
+
+
+def main(workers=None, shard_size=None, chunksize=64):
     """
     Preprocesses raw json files and split into test and stored sets
     -> preprocess means removing extra information and only keeping deck id and card list
     -> card list is a single string containing sanitized card names (see utils) seperated by spaces
+    Raw files are processed by a pool of <workers> processes and written in file name order.
+    Without <shard_size> every deck is written to its own json file, otherwise decks are written
+    to json lines shards of <shard_size> decks (see corpus.iter_decks).
     """
-    for file in tqdm(constants.RAW_DECKS.iterdir()):
-        processed_json = {}
-        with open(file, 'r') as f:
-            data = json.load(f)
-        processed_json['id'] = data['urlhash']
+    for directory in (constants.STORED_DECKS, constants.TEST_DECKS):
+        directory.mkdir(parents=True, exist_ok=True)
+
+    if shard_size is not None:
+        writers = {False: ShardWriter(constants.STORED_DECKS, shard_size), True: ShardWriter(constants.TEST_DECKS, shard_size)}
+
+    files = raw_files()
+    with Pool(workers) as pool:
+        for results in tqdm(pool.imap(process_file, files, chunksize), total=len(files)):
+            for stem, processed_json in results:
+                if processed_json is None:
+                    continue
+
+                test = is_test_deck(processed_json['id'])
+                if shard_size is not None:
+                    writers[test].write(processed_json)
+                    continue
+
+                if test:
+                    processed_file = constants.TEST_DECKS / f'{stem}.json'
+                else:
+                    processed_file = constants.STORED_DECKS / f'{stem}.json'
+                with open(processed_file, 'w') as f:
+                    json.dump(processed_json, f)
 
-        processed_decklist = list()
-        decklist = data['cards']
-        for card in decklist:
-            processed_decklist.append(utils.sanitize(card))
+    if shard_size is not None:
+        for writer in writers.values():
+            writer.close()
+    for directory in (constants.STORED_DECKS, constants.TEST_DECKS):
+        corpus.mark_changed(directory)
 
-        processed_decklist.append(utils.sanitize(data['commanders'][0]))
 
-        if len(processed_decklist) < 50:
+def _file_hash(file):
+    with open(file, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def _migrate_manifest(data):
+    """
+    Convert a manifest written by an older version of incremental, return None for a manifest that can't be converted.
+    """
+    if 'version' not in data:
+        # version 1: a raw file name -> entry dict, one deck per raw file with 'stem', 'id' and 'test' in the entry
+        return {name: {'size': entry['size'], 'mtime_ns': entry['mtime_ns'], 'sha1': entry['sha1'],
+                       'decks': [{'stem': entry['stem'], 'id': entry['id'], 'test': entry['test']}] if entry['id'] is not None else []}
+                for name, entry in data.items()}
+    if data['version'] == MANIFEST_VERSION:
+        return data['files']
+    return None
+
+
+def _load_manifest():
+    """
+    Raw file name -> {'size', 'mtime_ns', 'sha1', 'decks'}, 'decks' lists the 'stem', 'id' and 'test' of every processed deck of the file.
+    A manifest of an unknown version is dropped, so every raw file is processed again.
+    """
+    if not constants.MANIFEST.exists():
+        return dict()
+    with open(constants.MANIFEST, 'r') as f:
+        manifest = _migrate_manifest(json.load(f))
+    return manifest if manifest is not None else dict()
+
+
+def _save_manifest(manifest):
+    tmp = constants.MANIFEST.with_name(constants.MANIFEST.name + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump({'version': MANIFEST_VERSION, 'files': manifest}, f)
+    tmp.replace(constants.MANIFEST)
+
+
+def _processed_file(deck):
+    directory = constants.TEST_DECKS if deck['test'] else constants.STORED_DECKS
+    return directory / f'{deck["stem"]}.json'
+
+
+def find_changes(manifest):
+    """
+    Compare the raw decks with the manifest, return the changed (new or modified) raw file names with their hash
+    and the removed raw file names.
+    Files whose size and modification time are unchanged are skipped, files with a new modification time are hashed.
+    """
+    changed = dict()
+    seen = set()
+    for file in raw_files():
+        seen.add(file.name)
+        stat = file.stat()
+        entry = manifest.get(file.name)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            continue
+        sha1 = _file_hash(file)
+        if entry is not None and entry['sha1'] == sha1:
+            # touched but not modified
+            entry['size'], entry['mtime_ns'] = stat.st_size, stat.st_mtime_ns
             continue
+        changed[file.name] = sha1
+
+    removed = [name for name in manifest if name not in seen]
+    return changed, removed
+
+
+def incremental(workers=None, index=True, chunksize=64):
+    """
+    Only preprocess raw decks that are new or changed since the last run and remove decks that disappeared,
+    based on a manifest of raw file sizes, modification times and hashes (constants.MANIFEST).
+    With <index>, changed stored decks are sent to Solr in batches (see indexer.send) and removed ones are deleted from it.
+    Processed decks are written as one json file per deck, an up to date packed corpus of the directories is updated
+    with the changed decks only (see corpus.update) and the term statistics are refreshed only when something changed.
+    """
+    directories = {False: constants.STORED_DECKS, True: constants.TEST_DECKS}
+    for directory in directories.values():
+        directory.mkdir(parents=True, exist_ok=True)
+    # a stale corpus is ignored by corpus.open_corpus anyway, only current ones are worth updating
+    packed = {test: directory for test, directory in directories.items() if corpus.open_corpus(directory) is not None}
+
+    manifest = _load_manifest()
+    changed, removed = find_changes(manifest)
+
+    # processed decks and the ids of decks whose processed file was removed, per split (is_test_deck)
+    added = {False: list(), True: list()}
+    dropped = {False: list(), True: list()}
+
+    for name in removed:
+        for deck in manifest.pop(name)['decks']:
+            _processed_file(deck).unlink(missing_ok=True)
+            dropped[deck['test']].append(deck['id'])
+
+    files = [constants.RAW_DECKS / name for name in changed]
+    with Pool(workers) as pool:
+        for file, results in zip(files, tqdm(pool.imap(process_file, files, chunksize), total=len(files))):
+            old = manifest.get(file.name)
+            if old is not None:
+                for deck in old['decks']:
+                    _processed_file(deck).unlink(missing_ok=True)
+                    dropped[deck['test']].append(deck['id'])
+
+            decks = list()
+            for stem, processed_json in results:
+                if processed_json is None:
+                    continue
+                deck = {'stem': stem, 'id': processed_json['id'], 'test': is_test_deck(processed_json['id'])}
+                with open(_processed_file(deck), 'w') as f:
+                    json.dump(processed_json, f)
+                added[deck['test']].append(processed_json)
+                decks.append(deck)
+
+            stat = file.stat()
+            manifest[file.name] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha1': changed[file.name], 'decks': decks}
+
+    # delete before adding, a deck id can move to another raw file; decks that are added again are replaced anyway
+    if index:
+        readded = {processed_json['id'] for processed_json in added[False]}
+        for batch in indexer.batches([deck_id for deck_id in dropped[False] if deck_id not in readded], 1000):
+            indexer.delete_decks(batch)
+        indexer.send(added[False])
 
-        processed_json['cards'] = ' '.join(processed_decklist)
+    if changed or removed:
+        for directory in directories.values():
+            corpus.mark_changed(directory)
+        for test, directory in packed.items():
+            corpus.update(directory, dropped[test], ((processed_json['id'], processed_json['cards'].split(' ')) for processed_json in added[test]))
+        if index:
+            indexer.commit()
+            Terms.refresh()
 
-        if random.random() < TRAIN_TEST_SPLIT:
-            processed_file = constants.STORED_DECKS / f'{file.stem}.json'
-        else:
-            processed_file = constants.TEST_DECKS / f'{file.stem}.json'
-        with open(processed_file, 'w') as f:
-            json.dump(processed_json, f)
+    _save_manifest(manifest)
+    return changed, removed
 
 
 if __name__ == '__main__':
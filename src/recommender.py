@@ -1,87 +1,202 @@
-import math
 import numpy as np
-import requests
 import random
-from collections import defaultdict
-import matplotlib.pyplot as plt
 
 import utils
 import constants
+import backends
+import cache
+import deckbuilder
+import instrumentation
+import metrics
+from backends import Terms
 
 
-# Class to fetch term document frequency
-class Terms:
-    terms = None
-    size = None
-    @staticmethod
-    def get_terms():
-        if Terms.terms is None:
-            terms = requests.get('http://localhost:8983/solr/decks/terms', params={
-                'terms.fl': 'cards',
-                'terms.limit': -1,
-            }).json()['terms']['cards']
-            it = iter(terms)
-            Terms.terms = dict(zip(it, it))
-        return Terms.terms
-
-    @staticmethod
-    def get_collection_size():
-        if Terms.size is None:
-            r = requests.get('http://localhost:8983/solr/decks/select', params={
-                'q': '*:*',
-                'rows': 0
-            })
-            Terms.size = r.json()['response']['numFound']
-        return Terms.size
-
-def generate_recommendations(deck_string, k=None, similar_decks_count=10, use_deck_score=False, discount_factor=1.0, calculate_df_factor='no'):
+def generate_recommendations(deck_string, k=None, similar_decks_count=10, use_deck_score=False, discount_factor=1.0, calculate_df_factor='no', backend='solr'):
     """
     Generate k card recommendations for a (partial) commander deck.
+    Similar decks are retrieved with <backend>, see backends.BACKENDS.
     """
+    return generate_recommendations_batch([deck_string], k, similar_decks_count, use_deck_score, discount_factor, calculate_df_factor, backend)[0]
 
-    if calculate_df_factor == 'no':
-        calculate_df_factor = lambda _: 1
-    if calculate_df_factor == 'idf':
-        calculate_df_factor = lambda df: math.log(Terms.get_collection_size() / df)
-    if calculate_df_factor == 'prob-idf':
-        calculate_df_factor = lambda df: max(0, math.log((Terms.get_collection_size() - df)/ df))
-    if calculate_df_factor == 'df':
-        calculate_df_factor = lambda df: math.log(df)
 
-    r = requests.get('http://localhost:8983/solr/decks/mlt', params={
-        'stream.body': deck_string,
-        'mlt.interestingTerms': 'details',
-        'mlt.mindf': 0,
-        'mlt.mintf': 0,
-        'mlt.boost': 'true',
-        'fl': 'id, cards, score',
-        'rows': similar_decks_count
-    })
+def df_factors(calculate_df_factor, df, collection_size):
+    """
+    Vectorized version of the <calculate_df_factor> options of generate_recommendations, for an array of document frequencies.
+    """
+    df = np.asarray(df, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if calculate_df_factor == 'no':
+            return np.ones_like(df)
+        if calculate_df_factor == 'idf':
+            return np.log(collection_size / df)
+        if calculate_df_factor == 'prob-idf':
+            return np.maximum(0, np.log((collection_size - df) / df))
+        if calculate_df_factor == 'df':
+            return np.log(df)
+    raise ValueError(f'Unknown calculate_df_factor: {calculate_df_factor}')
+
+
+def _deck_weights(deck_scores, use_deck_score, discount_factor):
+    """
+    Weight of every similar deck's cards, the discount of the i-th deck is discount_factor ** i.
+    """
+    # accumulate the discount like generate_recommendations does
+    discounts = np.cumprod(np.concatenate(([1.0], np.full(max(len(deck_scores) - 1, 0), discount_factor))))[:len(deck_scores)]
+    return discounts * deck_scores if use_deck_score else discounts
+
+
+def _cached(deck_strings, k, parameters, backend, generate):
+    """
+    Look up the rankings of <deck_strings> in the result cache (see cache.configure),
+    <generate>(deck strings) computes the full rankings of the decks that are not cached.
+    """
+    results = cache.get_cache()
+    if results is None:
+        return None
+
+    keys = [cache.cache_key(deck_string, parameters, backend) for deck_string in deck_strings]
+    rankings = [results.get(key) for key in keys]
+    missing = [i for i, ranking in enumerate(rankings) if ranking is None]
+    instrumentation.count('cache.hits', len(keys) - len(missing))
+    instrumentation.count('cache.misses', len(missing))
+    if missing:
+        generated = generate([deck_strings[i] for i in missing])
+        results.put_many([(keys[i], ranking) for i, ranking in zip(missing, generated)])
+        for i, ranking in zip(missing, generated):
+            rankings[i] = ranking
+    # full rankings are cached, every k is a prefix
+    return [list(ranking[:k]) if k is not None else list(ranking) for ranking in rankings]
+
+
+def generate_recommendations_batch(deck_strings, k=None, similar_decks_count=10, use_deck_score=False, discount_factor=1.0, calculate_df_factor='no', backend='solr', chunk_size=64):
+    """
+    Generate k card recommendations for every deck in <deck_strings>, see generate_recommendations.
+    Similar decks are retrieved for all queries at once and card scores are accumulated as a
+    (queries x cards) matrix, <chunk_size> queries at a time.
+    """
+    backend = backends.get_backend(backend)
+    parameters = dict(similar_decks_count=similar_decks_count, use_deck_score=use_deck_score, discount_factor=discount_factor, calculate_df_factor=calculate_df_factor)
+    cached = _cached(deck_strings, k, parameters, backend, lambda missing: _recommendations_batch(missing, None, backend=backend, chunk_size=chunk_size, **parameters))
+    if cached is not None:
+        return cached
+    return _recommendations_batch(deck_strings, k, backend=backend, chunk_size=chunk_size, **parameters)
+
+
+def _recommendations_batch(deck_strings, k, similar_decks_count, use_deck_score, discount_factor, calculate_df_factor, backend, chunk_size):
+    instrumentation.observe('recommend.batch_size', len(deck_strings))
+    with instrumentation.timer('recommend.term_statistics'):
+        vocabulary = backend.vocabulary()
+        factors = df_factors(calculate_df_factor, backend.document_frequencies(), backend.collection_size())
+        n_cards = len(vocabulary)
+
+    with instrumentation.timer('recommend.similar_decks'):
+        neighbours = backend.similar_decks_batch(deck_strings, similar_decks_count)
 
-    decks = r.json()['response']['docs']
-    query_cards_set = set(deck_string.split(' '))
+    recommendations = list()
+    for start in range(0, len(deck_strings), chunk_size):
+        chunk = range(start, min(start + chunk_size, len(deck_strings)))
+        with instrumentation.timer('recommend.scoring'):
+            keys = list()
+            weights = list()
+            query_keys = list()
+            for row, q in enumerate(chunk):
+                ids, deck_scores, indptr, indices = neighbours[q]
+                lengths = np.diff(indptr)
 
-    cards_score = defaultdict(lambda: 0)
-    discount = 1.0
-    for deck in decks:
-        deck_score = deck['score']
-        deck_cards = set(deck['cards'].split(' '))
+                deck_weights = _deck_weights(deck_scores, use_deck_score, discount_factor)
 
-        cards = deck_cards - query_cards_set
-        for card in cards:
-            term_freq = Terms.get_terms()[card]
+                keys.append(indices + row * n_cards)
+                weights.append(np.repeat(deck_weights, lengths) * factors[indices])
+                query_keys.append(vocabulary.encode(deck_strings[q].split(' ')).astype(np.int64) + row * n_cards)
 
-            card_score = deck_score if use_deck_score else 1
-            
-            cards_score[card] += discount * card_score * calculate_df_factor(term_freq)
+            keys = np.concatenate(keys)
+            weights = np.concatenate(weights)
+            keep = ~np.isin(keys, np.concatenate(query_keys))
+            keys, weights = keys[keep], weights[keep]
 
-        discount *= discount_factor
+            scores = np.bincount(keys, weights=weights, minlength=len(chunk) * n_cards).reshape(len(chunk), n_cards)
+            present = np.bincount(keys, minlength=len(chunk) * n_cards).reshape(len(chunk), n_cards) > 0
 
-    result = sorted(cards_score.items(), key=lambda t: t[1], reverse=True)
-    if k is None:
-        return list(t[0] for t in result)
-    else:
-        return list(t[0] for t in result[:k])
+        with instrumentation.timer('recommend.ranking'):
+            for row in range(len(chunk)):
+                candidates = np.flatnonzero(present[row])
+                ranking = candidates[np.argsort(-scores[row, candidates], kind='stable')]
+                if k is not None:
+                    ranking = ranking[:k]
+                recommendations.append(vocabulary.decode(ranking))
+
+    return recommendations
+
+
+DEFAULT_PARAMETERS = dict(similar_decks_count=10, use_deck_score=False, discount_factor=1.0, calculate_df_factor='no')
+
+
+def generate_recommendations_sweep(deck_strings, parameter_grid, k=None, backend='solr'):
+    """
+    Generate k card recommendations for every point of <parameter_grid> (see utils.ParameterGrid) and every deck in <deck_strings>.
+    Similar decks are retrieved once per deck, at the largest similar_decks_count of the grid,
+    every grid point is then scored from those neighbours as one (grid points x neighbours) @ (neighbours x cards) product.
+    Return for every deck the list of recommendations of every grid point, in grid order.
+    """
+    backend = backends.get_backend(backend)
+    points = [{**DEFAULT_PARAMETERS, **parameters} for parameters in parameter_grid]
+    results = cache.get_cache()
+    if results is None:
+        return _sweep(deck_strings, points, k, backend)
+
+    # every grid point is cached as its own ranking, decks with a missing point are swept again
+    # sweep rankings may order ties differently than generate_recommendations_batch, so they get their own keys
+    keys = [[cache.cache_key(deck_string, {**p, 'sweep': True}, backend) for p in points] for deck_string in deck_strings]
+    rankings = [[results.get(key) for key in row] for row in keys]
+    missing = [d for d, row in enumerate(rankings) if any(ranking is None for ranking in row)]
+    if missing:
+        swept = _sweep([deck_strings[d] for d in missing], points, None, backend)
+        results.put_many([(keys[d][i], ranking) for d, row in zip(missing, swept) for i, ranking in enumerate(row)])
+        for d, row in zip(missing, swept):
+            rankings[d] = row
+    return [[list(ranking[:k]) if k is not None else list(ranking) for ranking in row] for row in rankings]
+
+
+def _sweep(deck_strings, points, k, backend):
+    vocabulary = backend.vocabulary()
+    df = backend.document_frequencies()
+    factors = {p['calculate_df_factor']: df_factors(p['calculate_df_factor'], df, backend.collection_size()) for p in points}
+
+    rows = max(p['similar_decks_count'] for p in points)
+    neighbours = backend.similar_decks_batch(deck_strings, rows)
+
+    recommendations = list()
+    for deck_string, (ids, deck_scores, indptr, indices) in zip(deck_strings, neighbours):
+        query = vocabulary.encode(deck_string.split(' '))
+
+        # incidence matrix of the neighbours over the cards they contain that are not in the query
+        local, columns = np.unique(indices, return_inverse=True)
+        incidence = np.zeros((len(ids), len(local)))
+        incidence[np.repeat(np.arange(len(ids)), np.diff(indptr)), columns] = 1
+        keep = ~np.isin(local, query)
+        incidence, local = incidence[:, keep], local[keep]
+
+        # seen[i] holds the cards of the first i + 1 neighbours
+        seen = np.maximum.accumulate(incidence, axis=0) > 0
+        weights = np.zeros((len(points), len(ids)))
+        counts = list()
+        for i, p in enumerate(points):
+            count = min(p['similar_decks_count'], len(ids))
+            weights[i, :count] = _deck_weights(deck_scores[:count], p['use_deck_score'], p['discount_factor'])
+            counts.append(count)
+        scores = weights @ incidence
+
+        result = list()
+        for i, p in enumerate(points):
+            card_scores = scores[i] * factors[p['calculate_df_factor']][local]
+            candidates = np.flatnonzero(seen[counts[i] - 1]) if counts[i] > 0 else np.zeros(0, dtype=np.int64)
+            ranking = local[candidates[np.argsort(-card_scores[candidates], kind='stable')]]
+            if k is not None:
+                ranking = ranking[:k]
+            result.append(vocabulary.decode(ranking))
+        recommendations.append(result)
+
+    return recommendations
 
 
 def deck_to_testcase(deck, leave_out_count=25, seed=None):
@@ -90,9 +205,9 @@ def deck_to_testcase(deck, leave_out_count=25, seed=None):
     Return the modified deck and the taken out cards.
     The taken out cards act as a set of relevant cards for calculating recall.
     """
-    if seed is not None:
-        random.seed(seed)
-    leave_out_set = set(random.sample(deck, leave_out_count))
+    # a test case owns its random generator, so the left out cards don't depend on what ran before it
+    rng = random.Random(seed) if seed is not None else random
+    leave_out_set = set(rng.sample(deck, leave_out_count))
     query_set = set(deck) - leave_out_set
 
     return query_set, leave_out_set
@@ -102,24 +217,14 @@ def r_precision(recommendations, relevant_cards):
     """
     Calculate R-precision
     """
-    k = len(relevant_cards)
-    correct_retrieved = set(recommendations[:k]) & relevant_cards
-    return len(correct_retrieved) / k
+    return float(metrics.r_precision(metrics.relevance(recommendations, relevant_cards), len(relevant_cards)))
 
 
 def average_precision(recommendations, relevant_cards):
     """
     Calculate average precision ~ area under precision-recall curve
     """
-    result = 0
-    for k, r in enumerate(recommendations):
-        if r in relevant_cards:
-            correct_retrieved = set(recommendations[:k+1]) & relevant_cards
-            result += len(correct_retrieved) / (k+1)
-
-    c = len(set(recommendations) & relevant_cards)
-
-    return result / c if c > 0 else 0
+    return float(metrics.average_precision(metrics.relevance(recommendations, relevant_cards)))
 
 
 def pr_values(recommendations, relevant_cards):
@@ -127,22 +232,16 @@ def pr_values(recommendations, relevant_cards):
     Calculate precision@k and recall@k values for a ranked list of recommendation based on a set of relevant cards.
     k values from 1 to the length of the recommendations list will be used.
     """
-
-    P = list()
-    R = list()
-    for k in range(0, len(recommendations)):
-        correct_retrieved = set(recommendations[:k+1]) & relevant_cards
-        c = len(correct_retrieved)
-        P.append(c / (k+1))
-        R.append(c / len(relevant_cards))
-
-    return P, R
+    return metrics.precision_recall(metrics.relevance(recommendations, relevant_cards), len(relevant_cards))
 
 
 def pr_curve(P, R):
     """
     Create a precision-recall curve plot.
     """
+    # imported here, matplotlib is slow to import and only needed for plotting
+    import matplotlib.pyplot as plt
+
     # https://stackoverflow.com/questions/39836953/how-to-draw-a-precision-recall-curve-with-interpolation-in-python
     P_interpolated = np.maximum.accumulate(np.array(P)[::-1])[::-1]
     
@@ -155,15 +254,23 @@ def pr_curve(P, R):
     ax.set_ylim([-0.01, 1.01])
 
 
-def generate_deck(commander, k=1, deck_size=80):
+def generate_deck(commander, k=1, deck_size=80, backend='solr'):
     """
     Fun procedure to generate a full commander deck by starting with a commander and expanding the deck by repeatedly picking from the top k recommendations.
     Deck size lower than 100 to account for manually deciding on basic land counts.
+    On the matrix backend the recommendations are updated incrementally, see deckbuilder.DeckBuilder.
     """
+    if isinstance(backends.get_backend(backend), backends.MatrixBackend):
+        builder = deckbuilder.DeckBuilder([commander], backend=backend)
+        while len(builder.deck) < deck_size:
+            index = random.randrange(k)
+            builder.add_card(builder.top_k(k)[index])
+        return builder.deck
+
     deck = [commander]
     while len(deck) < deck_size:
         index = random.randrange(k)
-        deck.append(generate_recommendations(" ".join(deck), k=k)[index])
+        deck.append(generate_recommendations(" ".join(deck), k=k, backend=backend)[index])
 
     return deck
 
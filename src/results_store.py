@@ -0,0 +1,123 @@
+import os
+import sqlite3
+import numpy as np
+
+import metrics
+import plots
+
+STORE_FILE = 'results.sqlite'
+
+
+class ResultStore:
+    """
+    Evaluated test cases of all experiments in one sqlite file <path>: a row per (experiment, deck, seed, config)
+    with the METRICS of metrics.py, the ranks of the relevant recommendations (for precision-recall curves)
+    and optionally the ranked list itself. Summaries are aggregated from the rows, see summary.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._connection = None
+        self._pid = None
+
+    def _db(self):
+        # a sqlite connection can't be shared with forked worker processes
+        if self._connection is None or self._pid != os.getpid():
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._connection = sqlite3.connect(self.path, timeout=60)
+            columns = ', '.join(f'{metric} REAL' for metric in metrics.METRICS)
+            self._connection.execute(f'''CREATE TABLE IF NOT EXISTS results (
+                experiment TEXT, deck TEXT, seed INTEGER, config TEXT, {columns},
+                length INTEGER, n_relevant INTEGER, hits BLOB, ranking TEXT,
+                PRIMARY KEY (experiment, deck, seed, config))''')
+            self._connection.execute('CREATE TEMP TABLE selected (deck TEXT, seed INTEGER, PRIMARY KEY (deck, seed))')
+            self._pid = os.getpid()
+        return self._connection
+
+    def add(self, experiment, test_cases):
+        """
+        Store a list of evaluated test cases (deck id, seed, rows), a row is (config, metric values, relevance vector, number of relevant cards, ranking or None).
+        Every call is one transaction, so a test case is either stored completely or not at all.
+        """
+        placeholders = ', '.join('?' * (len(metrics.METRICS) + 8))
+        db = self._db()
+        with db:
+            db.executemany(f'INSERT OR REPLACE INTO results VALUES ({placeholders})', [
+                (experiment, deck_id, seed, str(config), *map(float, values), len(rel), int(n_relevant),
+                 np.flatnonzero(rel).astype(np.int32).tobytes(), ' '.join(ranking) if ranking is not None else None)
+                for deck_id, seed, rows in test_cases
+                for config, values, rel, n_relevant, ranking in rows
+            ])
+
+    def completed(self, experiment, configs=None):
+        """
+        (deck id, seed) of every test case of <experiment> stored with all <configs>, by default all configs stored
+        for the experiment, so a test case lacking a config (e.g. one added to a parameter grid) is not completed.
+        """
+        rows = self._db().execute('SELECT deck, seed, config FROM results WHERE experiment = ?', (experiment,)).fetchall()
+        configs = {str(config) for config in configs} if configs is not None else {config for _, _, config in rows}
+        stored = dict()
+        for deck_id, seed, config in rows:
+            if config in configs:
+                stored.setdefault((deck_id, seed), set()).add(config)
+        return {case for case, case_configs in stored.items() if len(case_configs) == len(configs)}
+
+    def clear(self, experiment):
+        db = self._db()
+        with db:
+            db.execute('DELETE FROM results WHERE experiment = ?', (experiment,))
+
+    def _select(self, cases):
+        # restrict queries to <cases> by joining a temporary table, or to all test cases
+        db = self._db()
+        with db:
+            db.execute('DELETE FROM selected')
+            if cases is not None:
+                db.executemany('INSERT OR IGNORE INTO selected VALUES (?, ?)', cases)
+        return 'JOIN selected USING (deck, seed)' if cases is not None else ''
+
+    def summary(self, experiment, cases=None):
+        """
+        Mean METRICS per config over the test cases of <experiment>, or the (deck id, seed) <cases> of it,
+        as a dict config -> array, configs in the order they were first stored.
+        """
+        join = self._select(cases)
+        means = ', '.join(f'AVG({metric})' for metric in metrics.METRICS)
+        rows = self._db().execute(f'''SELECT config, {means} FROM results {join}
+            WHERE experiment = ? GROUP BY config ORDER BY MIN(results.rowid)''', (experiment,)).fetchall()
+        return {row[0]: np.array(row[1:]) for row in rows}
+
+    def pr_values(self, experiment, cases=None, seed_count=1):
+        """
+        The precision-recall data of the test cases as plots.PRValues, with the test case folders run_experiment uses.
+        """
+        join = self._select(cases)
+        values = plots.PRValues()
+        for deck_id, seed, config, length, n_relevant, hits in self._db().execute(f'''SELECT deck, seed, config, length, n_relevant, hits
+                FROM results {join} WHERE experiment = ? ORDER BY results.rowid''', (experiment,)):
+            values.folders.append(f'{deck_id}/seed={seed}' if seed_count > 1 else deck_id)
+            values.keys.append(config)
+            values.lengths.append(length)
+            values.n_relevant.append(n_relevant)
+            values.hits.append(np.frombuffer(hits, dtype=np.int32))
+        return values
+
+    def ranking(self, experiment, deck_id, seed, config):
+        """
+        The stored ranked list of a test case, or None when rankings weren't stored.
+        """
+        row = self._db().execute('SELECT ranking FROM results WHERE experiment = ? AND deck = ? AND seed = ? AND config = ?',
+                                 (experiment, deck_id, seed, str(config))).fetchone()
+        return row[0].split(' ') if row is not None and row[0] is not None else None
+
+    def experiments(self):
+        """
+        Number of test cases and rows of every experiment in the store.
+        """
+        return {experiment: (test_cases, rows) for experiment, test_cases, rows in self._db().execute(
+            "SELECT experiment, COUNT(DISTINCT deck || '/' || seed), COUNT(*) FROM results GROUP BY experiment")}
+
+
+if __name__ == '__main__':
+    import pathlib
+    for experiment, (test_cases, rows) in ResultStore(pathlib.Path('results') / STORE_FILE).experiments().items():
+        print(f'{experiment}\t{test_cases} test cases\t{rows} rows')
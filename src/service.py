@@ -0,0 +1,267 @@
+import asyncio
+import collections
+import json
+import math
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+import backends
+import cache
+import recommender
+
+HOST = '127.0.0.1'
+PORT = 8080
+# options of the calculate_df_factor parameter, see recommender.df_factors
+DF_FACTORS = ('no', 'idf', 'prob-idf', 'df')
+
+
+class Stats:
+    """
+    Latency of the last <window> requests and the sizes of the micro-batches they were scored in.
+    """
+    def __init__(self, window=10000):
+        self.start = time.monotonic()
+        self.latencies = collections.deque(maxlen=window)
+        self.finished = collections.deque(maxlen=window)
+        self.batch_sizes = collections.deque(maxlen=window)
+        self.requests = 0
+        self.errors = 0
+
+    def record(self, latency):
+        self.requests += 1
+        self.latencies.append(latency)
+        self.finished.append(time.monotonic())
+
+    def snapshot(self):
+        now = time.monotonic()
+        latencies = np.array(self.latencies) * 1000
+        recent = sum(1 for t in self.finished if now - t <= 60)
+        result = {
+            'requests': self.requests,
+            'errors': self.errors,
+            'uptime_seconds': now - self.start,
+            'throughput': self.requests / (now - self.start),
+            'throughput_last_minute': recent / min(60, now - self.start),
+            'mean_batch_size': float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.0,
+        }
+        if len(latencies):
+            for p in (50, 90, 99):
+                result[f'p{p}_ms'] = float(np.percentile(latencies, p))
+            result['mean_ms'] = float(latencies.mean())
+        if cache.get_cache() is not None:
+            result['cache'] = cache.get_cache().stats()
+        return result
+
+
+class MicroBatcher:
+    """
+    Groups concurrent recommendation requests into one recommender.generate_recommendations_batch call:
+    a batch is scored when <max_batch_size> requests are waiting or <max_wait> seconds after its first request.
+    Batches are scored one at a time in a worker thread, requests arriving meanwhile form the next batch.
+    """
+    def __init__(self, backend='solr', max_batch_size=32, max_wait=0.005, stats=None):
+        self.backend = backends.get_backend(backend)
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.stats = stats if stats is not None else Stats()
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(1)
+
+    def warm_up(self):
+        # load the term statistics and the vocabulary (or the matrix) before the first request
+        self.backend.vocabulary()
+        self.backend.document_frequencies()
+        self.backend.collection_size()
+
+    async def recommend(self, deck_string, k=None, **parameters):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((deck_string, k, {**recommender.DEFAULT_PARAMETERS, **parameters}, future))
+        return await future
+
+    async def _next_batch(self):
+        batch = [await self.queue.get()]
+        deadline = asyncio.get_running_loop().time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    def _score(self, batch):
+        # requests with the same parameters are scored together, at the largest k asked for
+        groups = collections.defaultdict(list)
+        for request in batch:
+            groups[tuple(sorted(request[2].items()))].append(request)
+
+        # (future, recommendations, exception), a group that fails only fails its own requests
+        results = list()
+        for parameters, requests in groups.items():
+            ks = [k for _, k, _, _ in requests]
+            k = None if None in ks else max(ks)
+            try:
+                recommendations = recommender.generate_recommendations_batch([deck_string for deck_string, _, _, _ in requests], k, backend=self.backend, **dict(parameters))
+            except Exception as e:
+                results.extend((future, None, e) for _, _, _, future in requests)
+                continue
+            for (_, k, _, future), result in zip(requests, recommendations):
+                results.append((future, result[:k] if k is not None else result, None))
+        return results
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            self.stats.batch_sizes.append(len(batch))
+            try:
+                results = await loop.run_in_executor(self.executor, self._score, batch)
+            except Exception as e:
+                for _, _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for future, result, exception in results:
+                if future.done():
+                    continue
+                if exception is not None:
+                    future.set_exception(exception)
+                else:
+                    future.set_result(result)
+
+
+def validate(query):
+    """
+    Check the deck, k and generate_recommendations parameters of a request before it joins a batch, so a bad request
+    can't fail the requests it would be scored with. Return (deck, k, parameters), raise a ValueError for a bad request.
+    """
+    if not isinstance(query, dict):
+        raise ValueError('expected a json object')
+    parameters = {key: value for key, value in query.items() if key not in ('deck', 'k')}
+    unknown = set(parameters) - set(recommender.DEFAULT_PARAMETERS)
+    if not isinstance(query.get('deck'), str) or unknown:
+        raise ValueError(f'expected a deck and parameters out of {list(recommender.DEFAULT_PARAMETERS)}')
+
+    # bools are ints in python, they are no valid counts
+    k = query.get('k')
+    if k is not None and (not isinstance(k, int) or isinstance(k, bool) or k <= 0):
+        raise ValueError(f'k must be a positive integer or null, not {k!r}')
+    count = parameters.get('similar_decks_count', 1)
+    if not isinstance(count, int) or isinstance(count, bool) or count <= 0:
+        raise ValueError(f'similar_decks_count must be a positive integer, not {count!r}')
+    if not isinstance(parameters.get('use_deck_score', False), bool):
+        raise ValueError(f'use_deck_score must be true or false, not {parameters["use_deck_score"]!r}')
+    discount_factor = parameters.get('discount_factor', 1.0)
+    if not isinstance(discount_factor, (int, float)) or isinstance(discount_factor, bool) or not math.isfinite(discount_factor):
+        raise ValueError(f'discount_factor must be a finite number, not {discount_factor!r}')
+    if parameters.get('calculate_df_factor', 'no') not in DF_FACTORS:
+        raise ValueError(f'calculate_df_factor must be one of {list(DF_FACTORS)}, not {parameters["calculate_df_factor"]!r}')
+    return query['deck'], k, parameters
+
+
+class Service:
+    """
+    HTTP/1.1 service with keep-alive connections:
+        + POST /recommend  {"deck": "<cards separated by spaces>", "k": 20, <generate_recommendations parameters>}
+        + GET  /recommend?deck=...&k=20
+          -> {"recommendations": [...]}
+        + GET  /stats  -> latency percentiles, throughput and batch sizes
+    """
+    def __init__(self, backend='solr', max_batch_size=32, max_wait=0.005):
+        self.stats = Stats()
+        self.batcher = MicroBatcher(backend, max_batch_size, max_wait, self.stats)
+
+    async def _recommend(self, query):
+        deck, k, parameters = validate(query)
+        return {'recommendations': await self.batcher.recommend(deck, k, **parameters)}
+
+    async def handle(self, method, target, body):
+        url = urllib.parse.urlsplit(target)
+        if url.path == '/stats':
+            return 200, self.stats.snapshot()
+        if url.path != '/recommend':
+            return 404, {'error': 'not found'}
+
+        start = time.monotonic()
+        try:
+            if method == 'POST':
+                query = json.loads(body or b'{}')
+            else:
+                query = dict(urllib.parse.parse_qsl(url.query))
+                for key, convert in (('k', int), ('similar_decks_count', int), ('discount_factor', float), ('use_deck_score', lambda v: v.lower() == 'true')):
+                    if key in query:
+                        query[key] = convert(query[key])
+            result = await self._recommend(query)
+        except (ValueError, TypeError) as e:
+            self.stats.errors += 1
+            return 400, {'error': str(e)}
+        self.stats.record(time.monotonic() - start)
+        return 200, result
+
+    async def _respond(self, writer, status, result, close):
+        payload = json.dumps(result).encode()
+        writer.write(f'HTTP/1.1 {status} {"OK" if status == 200 else "Error"}\r\n'.encode())
+        writer.write(f'Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n'.encode())
+        writer.write(b'Connection: close\r\n\r\n' if close else b'\r\n')
+        writer.write(payload)
+        await writer.drain()
+
+    async def connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                request = request_line.decode('latin-1').split(' ', 2)
+                headers = dict()
+                while len(request) == 3:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                # without a valid request line or length the next request can't be found, the connection is closed
+                length = headers.get('content-length', '0')
+                if len(request) != 3 or not length.isdigit():
+                    self.stats.errors += 1
+                    error = 'malformed request line' if len(request) != 3 else f'invalid Content-Length: {length!r}'
+                    await self._respond(writer, 400, {'error': error}, True)
+                    break
+                method, target, _ = request
+                body = await reader.readexactly(int(length))
+
+                try:
+                    status, result = await self.handle(method, target, body)
+                except Exception as e:
+                    self.stats.errors += 1
+                    status, result = 500, {'error': repr(e)}
+
+                close = headers.get('connection', '').lower() == 'close'
+                await self._respond(writer, status, result, close)
+                if close:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host=HOST, port=PORT):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.batcher.executor, self.batcher.warm_up)
+        batcher = asyncio.create_task(self.batcher.run())
+        server = await asyncio.start_server(self.connection, host, port)
+        print(f'serving recommendations on http://{host}:{port}')
+        async with server:
+            try:
+                await server.serve_forever()
+            finally:
+                batcher.cancel()
+
+
+if __name__ == '__main__':
+    asyncio.run(Service().serve())
@@ -0,0 +1,65 @@
+import json
+import numpy as np
+
+import constants
+import corpus
+from vocabulary import Vocabulary
+
+
+def commanders(sequence_ptr, sequence):
+    """
+    Card id of the commander of every deck: preprocess.process_deck appends it as the last card of the card list.
+    """
+    sequence_ptr = np.asarray(sequence_ptr)
+    empty = np.diff(sequence_ptr) == 0
+    last = np.asarray(sequence)[np.maximum(sequence_ptr[1:] - 1, 0)].astype(np.int64)
+    return np.where(empty, -1, last)
+
+
+def assign(deck_commanders, n_shards):
+    """
+    Shard of every commander: commanders with the most decks first, each to the shard holding the fewest decks so far,
+    so shards are about the same size and all decks of a commander share a shard.
+    Return a dict commander card id -> shard and the shard of every deck.
+    """
+    ids, counts = np.unique(deck_commanders, return_counts=True)
+    loads = np.zeros(n_shards, dtype=np.int64)
+    shard_of = dict()
+    for i in np.lexsort((ids, -counts)):
+        shard = int(np.argmin(loads))
+        shard_of[int(ids[i])] = shard
+        loads[shard] += counts[i]
+
+    lookup = np.vectorize(shard_of.get, otypes=[np.int64])
+    return shard_of, lookup(deck_commanders) if len(deck_commanders) else np.zeros(0, dtype=np.int64)
+
+
+def write(directory=None, n_shards=8, output=None):
+    """
+    Split the processed decks of <directory> (default constants.STORED_DECKS) into <n_shards> directories of json lines
+    shards <output>/shard-<n>, one per shard, e.g. to index every shard into its own Solr core with indexer.index.
+    The commander -> shard assignment is written to <output>/commanders.json.
+    """
+    directory = directory if directory is not None else constants.STORED_DECKS
+    output = output if output is not None else directory.with_suffix('.shards')
+    decks = list(corpus.iter_decks(directory))
+    arrays = corpus.read_decks(decks)
+    cards = Vocabulary.from_array(arrays['cards'])
+    shard_of, deck_shards = assign(commanders(arrays['sequence_ptr'], arrays['sequence']), n_shards)
+
+    files = list()
+    for shard in range(n_shards):
+        (output / f'shard-{shard:02d}').mkdir(parents=True, exist_ok=True)
+        files.append(open(output / f'shard-{shard:02d}' / 'shard-00000.jsonl', 'w'))
+    for (deck_id, deck_cards), shard in zip(decks, deck_shards):
+        files[shard].write(json.dumps({'id': deck_id, 'cards': ' '.join(deck_cards)}) + '\n')
+    for f in files:
+        f.close()
+
+    with open(output / 'commanders.json', 'w') as f:
+        json.dump({cards.cards[commander]: shard for commander, shard in shard_of.items() if commander >= 0}, f)
+    return output
+
+
+if __name__ == '__main__':
+    print(f'{constants.STORED_DECKS} -> {write()}')
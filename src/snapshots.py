@@ -0,0 +1,98 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+
+import constants
+
+
+def snapshot_path(name, version):
+    return constants.CACHE / name / str(version)
+
+
+def directory_version(directory):
+    """
+    Hash of the file names, sizes and modification times in <directory>, changes whenever a file is added, removed or rewritten.
+    """
+    h = hashlib.sha1()
+    for entry in sorted(os.scandir(directory), key=lambda e: e.name):
+        stat = entry.stat()
+        h.update(f'{entry.name}\t{stat.st_size}\t{stat.st_mtime_ns}\n'.encode())
+    return h.hexdigest()[:16]
+
+
+def encode_strings(strings):
+    """
+    Store a list of strings without spaces or newlines as a single uint8 array.
+    """
+    return np.frombuffer('\n'.join(strings).encode(), dtype=np.uint8)
+
+
+def decode_strings(array):
+    if len(array) == 0:
+        return list()
+    return np.asarray(array).tobytes().decode().split('\n')
+
+
+def exists(name, version):
+    return (snapshot_path(name, version) / 'meta.json').exists()
+
+
+def save(name, version, arrays, meta=None):
+    """
+    Save a dict of arrays and a json serializable dict as snapshot <version> of <name>.
+    Every call writes to its own temporary directory that is renamed into place, so processes saving the same
+    snapshot concurrently don't interfere: the first rename wins and a snapshot that already exists counts as saved.
+    Other versions are kept, processes may still be reading them, see prune.
+    """
+    path = snapshot_path(name, version)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = tempfile.mkdtemp(prefix=f'{path.name}.', suffix='.tmp', dir=path.parent)
+    try:
+        for key, array in arrays.items():
+            np.save(os.path.join(tmp, f'{key}.npy'), array)
+        # meta.json is written last and marks the snapshot as complete
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump({'arrays': list(arrays), 'meta': meta or dict()}, f)
+
+        try:
+            # renaming onto an existing, non-empty directory fails, the snapshot was saved by another process then
+            os.rename(tmp, path)
+        except OSError:
+            if not exists(name, version):
+                raise
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def prune(name, keep=1):
+    """
+    Remove all but the <keep> most recently saved versions of <name>, only when no process is using them.
+    """
+    directory = constants.CACHE / name
+    if not directory.is_dir():
+        return
+    versions = sorted((path for path in directory.iterdir() if not path.name.endswith('.tmp')), key=lambda path: path.stat().st_mtime_ns, reverse=True)
+    for path in versions[keep:]:
+        shutil.rmtree(path)
+
+
+def load(name, version, mmap=True):
+    """
+    Load snapshot <version> of <name>, return a dict of (memory-mapped) arrays and the meta dict.
+    """
+    path = snapshot_path(name, version)
+    with open(path / 'meta.json', 'r') as f:
+        data = json.load(f)
+
+    arrays = {key: np.load(path / f'{key}.npy', mmap_mode='r' if mmap else None) for key in data['arrays']}
+    return arrays, data['meta']
+
+
+if __name__ == '__main__':
+    # remove the snapshots of earlier corpus versions, run it while no backend is loading
+    for directory in sorted(constants.CACHE.glob('*')):
+        if directory.is_dir():
+            prune(directory.name)
@@ -0,0 +1,82 @@
+import json
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import backends
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, data):
+        payload = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        backend = self.server.backend
+        handler = url.path.rsplit('/', 1)[-1]
+
+        if handler == 'mlt':
+            decks = backend.similar_decks(params.get('stream.body', ''), int(params.get('rows', 10)))
+            docs = [{'id': deck_id, 'score': score, 'cards': ' '.join(cards)} for deck_id, score, cards in decks]
+            self._reply({'response': {'numFound': len(docs), 'start': 0, 'docs': docs}})
+        elif handler == 'terms':
+            # Solr sorts terms by document frequency
+            terms = sorted(backend.terms().items(), key=lambda term: (-term[1], term[0]))
+            self._reply({'terms': {'cards': [value for term in terms for value in term]}})
+        elif handler == 'select':
+            self._reply({'response': {'numFound': backend.collection_size(), 'start': 0, 'docs': []}})
+        elif handler == 'luke':
+            self._reply({'index': {'version': backend.version(), 'numDocs': backend.collection_size()}})
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        # updates are accepted and ignored, so indexer.py can be timed against the stub
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self._reply({'responseHeader': {'status': 0}})
+
+
+class SolrStub:
+    """
+    Local stand-in for the Solr 'decks' core: answers /mlt, /terms, /select, /admin/luke and /update
+    like Solr does for backends.SolrBackend and indexer.py, computed by a matrix backend (see backends.MatrixBackend)
+    on <directory>. Use it as a context manager, the core's url is SolrStub.url.
+    """
+    def __init__(self, directory=None, host='127.0.0.1', port=0):
+        self.server = ThreadingHTTPServer((host, port), _Handler)
+        self.server.daemon_threads = True
+        self.server.backend = backends.MatrixBackend(directory)
+        self.url = f'http://{host}:{self.server.server_address[1]}/solr/decks'
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == '__main__':
+    stub = SolrStub(port=8983)
+    print(f'serving {stub.server.backend.directory} on {stub.url}')
+    stub.server.serve_forever()
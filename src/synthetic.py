@@ -0,0 +1,104 @@
+import base64
+import json
+import numpy as np
+
+COLORS = 'WUBRG'
+BASICS = {'W': 'Plains', 'U': 'Island', 'B': 'Swamp', 'R': 'Mountain', 'G': 'Forest'}
+# cards nearly every commander deck plays
+STAPLES = ['Sol Ring', 'Arcane Signet', 'Command Tower', 'Lightning Greaves', "Swiftfoot Boots", 'Swords to Plowshares', 'Cultivate', 'Counterspell']
+SYLLABLES = ['ak', 'bel', 'cor', 'dra', 'el', 'fen', 'gor', 'hal', 'ir', 'jas', 'kel', 'lor', 'mor', 'nyx', 'or', 'pra', 'quo', 'ruk', 'syl', 'tor', 'ul', 'vex', 'wyr', 'xan', 'yor', 'zek']
+WORDS = ['Angel', 'Bolt', 'Citadel', 'Dragon', 'Elixir', 'Familiar', 'Golem', 'Hydra', 'Idol', 'Journey', 'Knight', 'Lotus', 'Mage', 'Oracle', 'Pact', 'Ritual', 'Sphinx', 'Titan', 'Vampire', 'Wurm']
+
+
+def card_names(n, rng):
+    """
+    <n> different card names in the style of Magic cards, with the apostrophes, commas and split cards utils.sanitize deals with.
+    """
+    names = list()
+    seen = set()
+    while len(names) < n:
+        owner = ''.join(rng.choice(SYLLABLES, rng.integers(2, 4))).capitalize()
+        word = rng.choice(WORDS)
+        name = [f"{owner}'s {word}", f'{word} of {owner}', f'{owner}, the {word}', f'{word} // {owner}'][rng.integers(4)]
+        if name not in seen:
+            seen.add(name)
+            names.append(name)
+    return names
+
+
+class DeckGenerator:
+    """
+    Random commander decks with roughly the statistics of the EDHREC decks:
+        + <n_commanders> commanders with Zipf distributed popularity, every commander has one to three colors
+        + <n_cards> cards of zero to two colors with Zipf distributed popularity, a deck only plays cards of its commander's colors
+        + every commander has a theme of cards its decks play much more often than other decks
+        + decks are <deck_size> cards: the commander, most staples, basic lands (repeated) and cards of the commander's colors
+    """
+    def __init__(self, n_cards=5000, n_commanders=300, deck_size=100, theme_size=150, seed=0):
+        self.rng = np.random.default_rng(seed)
+        self.deck_size = deck_size
+
+        self.cards = np.array(card_names(n_cards + n_commanders, self.rng))
+        self.commanders = self.cards[n_cards:]
+        self.cards = self.cards[:n_cards]
+        self.card_colors = [self._colors(self.rng.integers(0, 3)) for _ in range(n_cards)]
+        self.card_popularity = 1 / np.arange(1, n_cards + 1) ** 0.8
+        self.rng.shuffle(self.card_popularity)
+        self.commander_colors = [self._colors(self.rng.integers(1, 4)) for _ in range(n_commanders)]
+        self.commander_popularity = 1 / np.arange(1, n_commanders + 1) ** 1.1
+        self.commander_popularity /= self.commander_popularity.sum()
+
+        # per commander: the cards its decks can play and how likely each one is
+        self.pools = list()
+        for colors in self.commander_colors:
+            legal = np.flatnonzero([card_colors <= colors for card_colors in self.card_colors])
+            weights = self.card_popularity[legal].copy()
+            theme = self.rng.choice(len(legal), min(theme_size, len(legal)), replace=False)
+            weights[theme] += 20 * weights.mean()
+            self.pools.append((legal, weights / weights.sum()))
+
+    def _colors(self, count):
+        return frozenset(self.rng.choice(list(COLORS), count, replace=False).tolist())
+
+    def deck_id(self):
+        # EDHREC deck hashes are 22 url-safe base64 characters
+        return base64.urlsafe_b64encode(self.rng.bytes(16)).decode()[:22]
+
+    def deck(self):
+        """
+        One raw deck as the scraper stores it: {'urlhash', 'commanders', 'cards'}.
+        """
+        commander = self.rng.choice(len(self.commanders), p=self.commander_popularity)
+        colors = sorted(self.commander_colors[commander])
+        legal, weights = self.pools[commander]
+
+        cards = [card for card in STAPLES if self.rng.random() < 0.8]
+        lands = int(self.rng.integers(10, 30))
+        cards.extend(BASICS[color] for color in self.rng.choice(colors, lands))
+        count = min(self.deck_size - 1 - len(cards), len(legal))
+        cards.extend(self.cards[self.rng.choice(legal, count, replace=False, p=weights)].tolist())
+
+        return {'urlhash': self.deck_id(), 'commanders': [str(self.commanders[commander])], 'cards': cards}
+
+    def decks(self, n_decks):
+        for _ in range(n_decks):
+            yield self.deck()
+
+
+def write_raw(directory, n_decks=2000, **parameters):
+    """
+    Write <n_decks> raw decks of a DeckGenerator with <parameters> to <directory> (e.g. constants.RAW_DECKS), one json file per deck.
+    Return the deck ids.
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+    ids = list()
+    for deck in DeckGenerator(**parameters).decks(n_decks):
+        with open(directory / f'{deck["urlhash"]}.json', 'w') as f:
+            json.dump(deck, f)
+        ids.append(deck['urlhash'])
+    return ids
+
+
+if __name__ == '__main__':
+    import constants
+    print(f'{len(write_raw(constants.RAW_DECKS))} decks written to {constants.RAW_DECKS}')
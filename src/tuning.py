@@ -0,0 +1,175 @@
+import math
+import pathlib
+import random
+import numpy as np
+
+import constants
+import metrics
+import recommender
+import utils
+
+
+class Tuner:
+    """
+    Evaluates parameter configurations (dicts of generate_recommendations parameters) on test decks and remembers
+    the <metric> (see metrics.METRICS) of every (configuration, deck), so no test case is evaluated twice.
+    Test cases leave out <leave_out_count> cards with a fixed <seed>, so evaluations are reproducible.
+    With <sweep>, the configurations are scored from one similar deck retrieval per deck, see recommender.generate_recommendations_sweep.
+    """
+    def __init__(self, configurations, metric='average_precision', leave_out_count=25, seed=0, k=1000, sweep=True, backend='solr', batch_size=64):
+        self.configurations = [dict(c) for c in configurations]
+        self.metric = metric
+        self.leave_out_count = leave_out_count
+        self.seed = seed
+        self.k = k
+        self.sweep = sweep
+        self.backend = backend
+        self.batch_size = batch_size
+        self.scores = dict() # (configuration index, deck id) -> metric value
+        self.calls = 0 # recommendation lists generated, one per (configuration, deck)
+        self._testcases = dict()
+
+    def _testcase(self, deck_id):
+        if deck_id not in self._testcases:
+            deck = utils.import_deck(constants.TEST_DECKS / f'{deck_id}.json')
+            query, relevant_cards = recommender.deck_to_testcase(deck, self.leave_out_count, self.seed)
+            self._testcases[deck_id] = " ".join(sorted(query)), relevant_cards
+        return self._testcases[deck_id]
+
+    def evaluate(self, configurations, deck_ids):
+        """
+        Evaluate the <configurations> (indices) on the <deck_ids> they have not been evaluated on yet.
+        """
+        # configurations missing the same decks are evaluated together
+        groups = dict()
+        for c in configurations:
+            missing = tuple(d for d in deck_ids if (c, d) not in self.scores)
+            if missing:
+                groups.setdefault(missing, list()).append(c)
+
+        for missing, group in groups.items():
+            for start in range(0, len(missing), self.batch_size):
+                decks = missing[start:start + self.batch_size]
+                testcases = [self._testcase(d) for d in decks]
+                queries = [query for query, _ in testcases]
+                if self.sweep:
+                    swept = recommender.generate_recommendations_sweep(queries, [self.configurations[c] for c in group], k=self.k, backend=self.backend)
+                    rankings = [[row[i] for row in swept] for i in range(len(group))]
+                else:
+                    rankings = [recommender.generate_recommendations_batch(queries, k=self.k, backend=self.backend, **self.configurations[c]) for c in group]
+
+                for c, lists in zip(group, rankings):
+                    values, _ = metrics.evaluate_batch([(recommendations, relevant) for recommendations, (_, relevant) in zip(lists, testcases)])
+                    for d, value in zip(decks, values[self.metric]):
+                        self.scores[c, d] = float(value)
+                self.calls += len(group) * len(decks)
+
+    def mean(self, configuration, deck_ids):
+        return float(np.mean([self.scores[configuration, d] for d in deck_ids]))
+
+    def ranking(self, configurations, deck_ids):
+        """
+        <configurations> from best to worst mean metric on <deck_ids>, ties in grid order.
+        """
+        means = {c: self.mean(c, deck_ids) for c in configurations}
+        return sorted(configurations, key=lambda c: (-means[c], c))
+
+
+def successive_halving(parameter_grid, deck_ids, min_decks=25, eta=3, seed=0, verify=False, **parameters):
+    """
+    Successive halving over the points of <parameter_grid> (see utils.ParameterGrid) on the <deck_ids> tune decks:
+    every configuration is evaluated on <min_decks> decks, the best 1 / <eta> of them survive and are evaluated on
+    <eta> times as many decks, until one configuration is left or all decks are used.
+    Decks are taken in a fixed order shuffled with <seed>, <parameters> are passed to Tuner.
+    With <verify>, the whole grid is evaluated on all decks as well, to check the full grid picks the same best configuration.
+    Return a report dict, see write_report.
+    """
+    tuner = Tuner(list(parameter_grid), seed=seed, **parameters)
+    order = sorted(deck_ids)
+    random.Random(seed).shuffle(order)
+
+    alive = list(range(len(tuner.configurations)))
+    budget = min(min_decks, len(order))
+    rungs = list()
+    while True:
+        decks = order[:budget]
+        tuner.evaluate(alive, decks)
+        alive = tuner.ranking(alive, decks)
+        rungs.append({'decks': budget, 'configurations': len(alive), 'best': tuner.mean(alive[0], decks), 'calls': tuner.calls})
+        if len(alive) == 1 or budget == len(order):
+            break
+        alive = alive[:max(1, math.ceil(len(alive) / eta))]
+        budget = min(budget * eta, len(order))
+
+    best = alive[0]
+    full_calls = len(tuner.configurations) * len(order)
+    report = {
+        'best': tuner.configurations[best],
+        'best_score': tuner.mean(best, decks),
+        'best_decks': len(decks),
+        'metric': tuner.metric,
+        'configurations': len(tuner.configurations),
+        'decks': len(order),
+        'calls': tuner.calls,
+        'full_grid_calls': full_calls,
+        'calls_saved': full_calls - tuner.calls,
+        'rungs': rungs,
+    }
+
+    if verify:
+        everything = list(range(len(tuner.configurations)))
+        tuner.evaluate(everything, order)
+        full_best = tuner.ranking(everything, order)[0]
+        report['full_grid_best'] = tuner.configurations[full_best]
+        report['full_grid_best_score'] = tuner.mean(full_best, order)
+        report['same_best'] = full_best == best
+    return report
+
+
+def write_report(report, file):
+    with open(file, 'w') as f:
+        f.write(f'best\t{report["best"]}\n')
+        f.write(f'{report["metric"]}\t{report["best_score"]:5.4f}\t({report["best_decks"]} decks)\n')
+        f.write(f'calls\t{report["calls"]}\tof {report["full_grid_calls"]} for the full grid of {report["configurations"]} configurations x {report["decks"]} decks\n')
+        f.write(f'saved\t{report["calls_saved"]}\t({report["calls_saved"] / report["full_grid_calls"]:.1%})\n')
+        if 'same_best' in report:
+            f.write(f'full grid best\t{report["full_grid_best"]}\t{report["full_grid_best_score"]:5.4f}\tsame: {report["same_best"]}\n')
+        f.write('\ndecks\tconfigurations\tbest\tcalls\n')
+        for rung in report['rungs']:
+            f.write(f'{rung["decks"]}\t{rung["configurations"]}\t{rung["best"]:5.4f}\t{rung["calls"]}\n')
+
+
+def tune(parameter_grid, deck_ids, name, root_directory='results', **parameters):
+    """
+    Run successive_halving and write its report to <root_directory>/<name>/tuning.txt.
+    """
+    report = successive_halving(parameter_grid, deck_ids, **parameters)
+    folder = pathlib.Path(root_directory) / name
+    folder.mkdir(parents=True, exist_ok=True)
+    write_report(report, folder / 'tuning.txt')
+    return report
+
+
+if __name__ == '__main__':
+    import experiments
+
+    random.seed(0)
+    tune_decks = set(random.sample(experiments.TEST_DECKS_IDS, 500))
+
+    # the grids of experiments.py
+    similar_decks_count2 = utils.ParameterGrid({
+        'similar_decks_count': list(range(25, 501, 25)),
+        'use_deck_score': [False],
+        'discount_factor': [1],
+        'calculate_df_factor': ['no']
+    })
+    combining_three = utils.ParameterGrid({
+        'similar_decks_count': [3, 4, 5, 6, 10, 1000],
+        'discount_factor': [1, 0.9, 0.8, 0.7, 0.6, 0.5],
+        'use_deck_score': [False, True],
+        'calculate_df_factor': ['no']
+    })
+
+    for grid, name in ((similar_decks_count2, 'similar_decks_count2_halving'), (combining_three, 'combining_three_halving')):
+        report = tune(grid, tune_decks, name, backend=experiments.BACKEND)
+        print(name, report['best'], f'{report["calls_saved"]} of {report["full_grid_calls"]} recommendation calls saved')
@@ -1,13 +1,29 @@
 import re
 import json
+import pathlib
+import functools
+
+import corpus
 
 from src import recommender
 
 
+SEPARATORS = re.compile(r'[\ \/]')
+PUNCTUATION = re.compile(r'[\#\$\%\&\'\(\)\*\+\,\.\:\;\<\=\>\?\@\[\\\]\^\_\`\{\|\}\~]')
+
+
+# card names repeat across decks, so sanitized names are memoized
+@functools.lru_cache(maxsize=2**16)
 def sanitize(card):
-    return re.sub(r'[\#\$\%\&\'\(\)\*\+\,\.\:\;\<\=\>\?\@\[\\\]\^\_\`\{\|\}\~]', '', re.sub(r'[\ \/]', '-', card)).lower().strip()
+    return PUNCTUATION.sub('', SEPARATORS.sub('-', card)).lower().strip()
 
 def import_deck(file):
+    # decks of a packed directory are read from its corpus file, see corpus.pack
+    file = pathlib.Path(file)
+    packed = corpus.open_corpus(file.parent)
+    if packed is not None and file.stem in packed:
+        return packed.deck(file.stem)
+
     with open(file, 'r') as f:
         data = json.load(f)
         return data['cards'].split(' ')
@@ -20,8 +36,8 @@ def float_to_filename_safe(x):
 
 class ParameterGrid:
     def __init__(self, grid):
-        self.grid = grid.values()
-        self.meaning = grid.keys()
+        self.grid = list(grid.values())
+        self.meaning = list(grid.keys())
 
         self.counts = [len(a) for a in self.grid]
         
@@ -0,0 +1,64 @@
+import numpy as np
+
+import snapshots
+
+# card ids are stored as uint16, enough for every Magic card printed so far
+MAX_CARDS = 2**16
+
+
+class Vocabulary:
+    """
+    Assigns every sanitized card name a dense integer id.
+    Decks are represented as sorted uint16 arrays of card ids, so set operations become array operations.
+    """
+    def __init__(self, cards=()):
+        self.cards = list()
+        self.card_index = dict()
+        for card in cards:
+            self.add(card)
+
+    def __len__(self):
+        return len(self.cards)
+
+    def __contains__(self, card):
+        return card in self.card_index
+
+    def add(self, card):
+        """
+        Return the id of <card>, assigning the next free id to unseen cards.
+        """
+        index = self.card_index.get(card)
+        if index is None:
+            index = len(self.cards)
+            if index >= MAX_CARDS:
+                raise ValueError(f'More than {MAX_CARDS} distinct cards')
+            self.card_index[card] = index
+            self.cards.append(card)
+        return index
+
+    def encode(self, cards, add=False):
+        """
+        Sorted array of the unique ids of <cards>, unknown cards are skipped unless <add> is set.
+        """
+        if add:
+            ids = [self.add(card) for card in cards if card]
+        else:
+            ids = [self.card_index[card] for card in cards if card in self.card_index]
+        return np.unique(np.array(ids, dtype=np.uint16))
+
+    def decode(self, ids):
+        return [self.cards[i] for i in ids]
+
+    def to_array(self):
+        return snapshots.encode_strings(self.cards)
+
+    @staticmethod
+    def from_array(array):
+        return Vocabulary(snapshots.decode_strings(array))
+
+
+def difference(deck, other):
+    """
+    Card ids of <deck> that are not in <other>, both sorted unique id arrays.
+    """
+    return np.setdiff1d(deck, other, assume_unique=True)